@@ -0,0 +1,36 @@
+# Script to time the repeat based upsampling of misc.upsample_df against the
+# resample path it replaced, on frames the size of the pipeline stages.
+
+# Python modules
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+
+# Custom scripts
+from scripts.misc import upsample_df, resample_df
+
+# process command line
+
+parser = argparse.ArgumentParser(description='Benchmark day to hour upsampling.')
+parser.add_argument('--cells', type=int, action="store", dest="cells", help='Number of grid cells (columns)', default=1000)
+parser.add_argument('--days', type=int, action="store", dest="days", help='Number of days', default=365)
+parser.add_argument('--freq', action="store", dest="freq", help='Frequency of the low resolution data eg D or 6H', default='D')
+parser.add_argument('--repeat', type=int, action="store", dest="repeat", help='Number of timings to take the best of', default=3)
+
+args = parser.parse_args()
+
+start = pd.Timestamp('2018-01-01')
+index = pd.date_range(start, start + pd.Timedelta(days=args.days), freq=args.freq, name='time')[:-1]
+df = pd.DataFrame(np.random.default_rng(0).random((len(index), args.cells)), index=index)
+
+print('{} rows of {} at {}, {} columns'.format(len(df), args.freq, index[0], args.cells))
+
+fast = upsample_df(df, '60min')
+slow = resample_df(df, '60min')
+pd.testing.assert_frame_equal(fast, slow, check_freq=False)
+print('Results are identical, {} hourly rows'.format(len(fast)))
+
+for name, function in [('resample', resample_df), ('repeat', upsample_df)]:
+    seconds = min(timeit.repeat(lambda: function(df, '60min'), number=1, repeat=args.repeat))
+    print('{:10} {:8.3f} s'.format(name, seconds))
@@ -0,0 +1,41 @@
+# Script to list or remove the intermediate results cached in the interim
+# directory by heat_series.py
+
+# Python modules
+import os
+import argparse
+from datetime import datetime
+
+# Custom scripts
+import scripts.cache as cache
+
+# process command line
+
+parser = argparse.ArgumentParser(description='List or purge cached intermediate results.')
+parser.add_argument('command', choices=['ls', 'purge'], help='ls to list the cache, purge to remove entries')
+parser.add_argument('--name', action="store", dest="name", help='Only entries whose name starts with this eg temperature_IGB', default=None)
+parser.add_argument("--older", type=float, action="store", dest="older", help="Only entries not used for this many days", default=None)
+parser.add_argument("--size", type=float, action="store", dest="size", help="purge: remove the least recently used entries until the cache is below this size in GB", default=None)
+
+args = parser.parse_args()
+
+interim_path = os.path.join(os.path.realpath('.'), 'interim')
+
+if args.command == 'ls':
+    entries = cache.entries(interim_path)
+    if args.name:
+        entries = [entry for entry in entries if entry['name'].startswith(args.name)]
+    for entry in entries:
+        print('{:50} {:10.1f} MB  {}'.format(entry['name'], entry['size'] / 1024 ** 2,
+              datetime.fromtimestamp(entry['used']).strftime('%Y-%m-%d %H:%M')))
+    total = sum(entry['size'] for entry in entries)
+    print('{} entries {:.1f} MB'.format(len(entries), total / 1024 ** 2))
+
+if args.command == 'purge':
+    if args.size is not None:
+        removed = cache.evict(interim_path, args.size * 1024 ** 3)
+    else:
+        removed = cache.purge(interim_path, args.name, args.older)
+    for entry in removed:
+        print('Removed {}'.format(entry['name']))
+    print('{} entries removed'.format(len(removed)))
@@ -0,0 +1,280 @@
+# Runs of the pipeline for several countries and weather years.
+# The inputs that are the same for every job (population mappings, hourly
+# profiles, parameter files) are loaded into the context before the jobs
+# start. For a single weather year the temperature and wind are also read
+# once for the grid points of all the countries and each country's grid
+# points are sliced out into the context.
+# The (country, weather year) jobs can be spread over a pool of processes,
+# which inherit the loaded context by forking. Each job is timed and a job
+# that fails, or whose process dies, is reported without stopping the others.
+# A job's population, wind and temperature are forgotten once it is done, so
+# the context does not grow with the number of years.
+
+# Python modules
+import copy
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+
+# Custom scripts
+from . import pipeline
+from . import cache
+
+# The context and configs of the batch, inherited by the pool processes
+_context = None
+_configs = {}
+
+
+def country_list(country):
+
+    # all, a comma separated list or one country
+    if country == 'all':
+        return list(pipeline.all_countries)
+    return country.split(',')
+
+
+def year_list(args):
+
+    # The weather years of the config: --years as first-last or a comma
+    # separated list, otherwise the weather year
+    if not args.years:
+        return [args.weather]
+    if '-' in args.years:
+        first, last = args.years.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(year) for year in args.years.split(',')]
+
+
+def load_inputs(args, countries, years, context):
+
+    # Load what the jobs share into the context so the pool processes
+    # inherit it instead of reading it again
+    for profile in pipeline.all_profiles if args.profile == 'all' else args.profile.split(','):
+        context.hourly_parameters(profile)
+    context.read('daily_parameters')
+    context.read('cop_parameters')
+    for country in countries:
+        # A country whose parameter files are missing is left to fail in its
+        # jobs
+        try:
+            context.read('annual_demand', country)
+            if args.electric:
+                context.read('electric_parameters', country)
+        except Exception as err:
+            print('Parameters of {} not loaded: {}'.format(country, err))
+        for year in years:
+            # A year whose population mapping fails is left to fail in its job
+            try:
+                context.population(args, country, year)
+            except Exception as err:
+                print('Population of {} {} not loaded: {}'.format(country, year, err))
+
+
+def load_weather(args, countries, context):
+
+    # Read the temperature and wind once for the grid points of all the
+    # countries and put each country's part in the context.
+    # Returns the errors of the countries whose population mapping failed,
+    # which are left out.
+    year = args.weather
+    populations = {}
+    errors = {}
+    for country in countries:
+        try:
+            populations[country] = context.population(args, country, year)
+        except Exception:
+            errors[country] = traceback.format_exc()
+            print('Population of {} {} failed, {} left out'.format(country, year, country))
+    if not populations:
+        return errors
+
+    cells = None
+    for mapped_population in populations.values():
+        cells = mapped_population.index if cells is None else cells.union(mapped_population.index)
+    population = pd.Series(1.0, index=cells.sort_values())
+
+    print('Reading the weather for {} grid points of {} countries ... '.format(len(population), len(populations)))
+    temperature = context.temperature(args, 'countries', year, population)
+    wind = context.wind(args, 'countries', year, population)
+
+    for country, mapped_population in populations.items():
+        context.preload_weather(args, country, year,
+                                temperature.select_cells(mapped_population.index),
+                                wind.reindex(mapped_population.index))
+
+    return errors
+
+
+def run_job(job):
+
+    # Run one job, returning its output files or the error and the time
+    # it took
+    start = time.time()
+    try:
+        files, error = pipeline.run(_configs[job], _context), None
+    except Exception:
+        files, error = None, traceback.format_exc()
+    # The weather of the job is not needed again, so the context does not
+    # grow with the number of jobs
+    _context.forget(job[1], job[0])
+    seconds = time.time() - start
+    print('Job {} {} {} in {:.1f} s'.format(job[0], job[1], 'failed' if error else 'done', seconds))
+    return files, error, seconds
+
+
+def pool_results(jobs, processes):
+
+    # Run the jobs in a pool of processes, returning the results of
+    # run_job by job.
+    # A process that dies, eg killed for running out of memory, breaks the
+    # pool and every job not yet done with it. Those jobs are run again one
+    # at a time, each in a process of its own, so only the job whose
+    # process dies again is reported as failed.
+    fork = multiprocessing.get_context('fork')
+    results = {}
+    broken = []
+    with ProcessPoolExecutor(processes, mp_context=fork) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except BrokenProcessPool:
+                broken.append(futures[future])
+
+    for job in jobs:
+        if job not in broken:
+            continue
+        print('Job {} {} running again on its own after a process died'.format(*job))
+        start = time.time()
+        with ProcessPoolExecutor(1, mp_context=fork) as pool:
+            try:
+                results[job] = pool.submit(run_job, job).result()
+            except BrokenProcessPool:
+                seconds = time.time() - start
+                print('Job {} {} failed in {:.1f} s'.format(job[0], job[1], seconds))
+                results[job] = None, 'The process of the job died, eg killed for running out of memory', seconds
+
+    return {job: results[job] for job in jobs}
+
+
+def run(args, context=None, processes=None):
+
+    # Run the config for each of its countries and weather years, in a pool
+    # of processes if processes is more than 1. Returns the output files,
+    # the errors and the times in seconds by (country, year).
+
+    global _context, _configs
+
+    if context is None:
+        context = pipeline.Context()
+    # The cache size applies to the inputs loaded before the jobs too
+    cache.max_size = args.cache_size * 1024 ** 3
+    countries = country_list(args.country)
+    years = year_list(args)
+
+    for year in years:
+        try:
+            pipeline.download_weather(context.input_path, args, year)
+        except Exception as err:
+            print('Weather for {} not downloaded: {}'.format(year, err))
+    load_inputs(args, countries, years, context)
+    # Countries whose population mapping failed are failed jobs
+    failed = {}
+    if len(years) == 1 and len(countries) > 1:
+        for country, error in load_weather(args, countries, context).items():
+            failed[(country, years[0])] = (None, error, 0.0)
+
+    _context = context
+    _configs = {}
+    for year in years:
+        for country in countries:
+            config = copy.copy(args)
+            config.country = country
+            config.weather = year
+            _configs[(country, year)] = config
+    jobs = [job for job in _configs if job not in failed]
+
+    if processes and processes > 1:
+        results = pool_results(jobs, processes)
+    else:
+        results = {job: run_job(job) for job in jobs}
+    results.update(failed)
+    jobs = list(_configs)
+
+    output_files = {}
+    errors = {}
+    times = {}
+    for job, (files, error, seconds) in results.items():
+        times[job] = seconds
+        if error is None:
+            output_files[job] = files
+        else:
+            print('Job {} {} failed:'.format(*job))
+            print(error)
+            errors[job] = error
+
+    print('{} jobs done, {} failed, {:.1f} s of job time'.format(len(jobs) - len(errors), len(errors), sum(times.values())))
+
+    return output_files, errors, times
+
+
+def run_continuous(args, context=None):
+
+    # One continuous series over the weather years for each country, run a
+    # year at a time and appended to one output so only a year is held in
+    # memory. The reference temperature carries on from the year before.
+    # A country whose year fails is reported and its series stops at the
+    # year before, the other countries carrying on.
+    # Returns the output files by country, the errors by (country, year)
+    # and the times in seconds by country.
+
+    if context is None:
+        context = pipeline.Context()
+    # The cache size applies to the inputs loaded before the jobs too
+    cache.max_size = args.cache_size * 1024 ** 3
+    # The years of a country follow one another, so they are run in this
+    # process
+    if args.processes and args.processes > 1:
+        raise ValueError('--continuous runs in one process, --processes is not used with it')
+    if not args.years:
+        raise ValueError('--continuous needs the weather years given by --years')
+    countries = country_list(args.country)
+    years = year_list(args)
+    if not years or years != list(range(years[0], years[-1] + 1)):
+        raise ValueError('--continuous needs consecutive years, not {}'.format(args.years))
+
+    output_files = {}
+    errors = {}
+    times = {}
+    for country in countries:
+        stream = {
+            'name': '{}-{}'.format(years[0], years[-1]),
+            'previous': None,
+            'append': False,
+        }
+        start = time.time()
+        for year in years:
+            config = copy.copy(args)
+            config.country = country
+            config.weather = year
+            year_start = time.time()
+            try:
+                output_files[country] = pipeline.run(config, context, stream)
+            except Exception:
+                errors[(country, year)] = traceback.format_exc()
+                print('Year {} of {} failed:'.format(year, country))
+                print(errors[(country, year)])
+                if country in output_files:
+                    print('The series of {} stops at {} in {}'.format(country, year - 1, output_files[country]))
+                break
+            finally:
+                context.forget(year)
+            print('Year {} of {} done in {:.1f} s'.format(year, country, time.time() - year_start))
+        times[country] = time.time() - start
+
+    print('{} countries done, {} failed, {:.1f} s'.format(len(countries) - len(errors), len(errors), sum(times.values())))
+
+    return output_files, errors, times
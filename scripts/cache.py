@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+# Intermediate results in the interim directory are stored under a key made
+# from a hash of everything they depend on: the source files (size and
+# modification time), the options and the code that produced them. A changed
+# input gives a new key, so stale results are never reused, and the least
+# recently used results are evicted when the cache grows past max_size.
+
+# Increase to invalidate everything already in the cache
+VERSION = 1
+
+# Size limit of the cache in bytes, None for no limit
+max_size = 20 * 1024 ** 3
+
+# The modules whose results are cached and the modules they use to make them
+code_files = ['read.py', 'preprocess.py', 'cache.py', 'misc.py', 'grid.py']
+
+_code_version = None
+
+
+def code_version():
+
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha1(str(VERSION).encode())
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for filename in code_files:
+            with open(os.path.join(directory, filename), 'rb') as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def file_stamp(file):
+
+    stat = os.stat(file)
+    return [os.path.basename(file), stat.st_size, stat.st_mtime_ns]
+
+
+def grid_hash(latitude, longitude):
+
+    # The weather grid by its coordinates, the same for every weather year
+    h = hashlib.sha1()
+    for coordinate in [latitude, longitude]:
+        h.update(np.asarray(np.ma.getdata(coordinate), dtype='float64').tobytes())
+    return h.hexdigest()
+
+
+def key(name, files=(), **options):
+
+    # name is kept at the front of the key so that entries can be recognised
+    inputs = {
+        'name': name,
+        'code': code_version(),
+        'files': [file_stamp(file) for file in files],
+        'options': options,
+    }
+    h = hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode())
+    return '{}_{}'.format(name, h.hexdigest()[:16])
+
+
+def path(interim_path, key, extension='.pkl'):
+
+    return os.path.join(interim_path, key + extension)
+
+
+def load(interim_path, key):
+
+    # Returns None if the key is not in the cache
+    file = path(interim_path, key)
+    if not os.path.isfile(file):
+        return None
+
+    with open(file, 'rb') as f:
+        value = pickle.load(f)
+
+    # Mark as recently used
+    os.utime(file)
+    print('{} already exists and is read from disk.'.format(file))
+    return value
+
+
+def save(interim_path, key, value):
+
+    file = path(interim_path, key)
+    with open(file + '.tmp', 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file + '.tmp', file)
+
+    evict(interim_path, max_size)
+
+
+def save_arrays(interim_path, key, arrays):
+
+    # Arrays are stored as .npy files in a directory so that they can be
+    # memory mapped when loaded. Returns them memory mapped as load_arrays.
+    directory = path(interim_path, key, '.arrays')
+    os.makedirs(directory + '.tmp', exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(directory + '.tmp', name + '.npy'), values)
+    os.replace(directory + '.tmp', directory)
+
+    evict(interim_path, max_size)
+    return map_arrays(directory)
+
+
+def map_arrays(directory):
+
+    arrays = {}
+    for filename in os.listdir(directory):
+        name = os.path.splitext(filename)[0]
+        arrays[name] = np.load(os.path.join(directory, filename), mmap_mode='r')
+    return arrays
+
+
+def load_arrays(interim_path, key):
+
+    # Returns a dictionary of read only memory mapped arrays, or None if the
+    # key is not in the cache
+    directory = path(interim_path, key, '.arrays')
+    if not os.path.isdir(directory):
+        return None
+
+    arrays = map_arrays(directory)
+
+    os.utime(directory)
+    print('{} already exists and is read from disk.'.format(directory))
+    return arrays
+
+
+def entry_size(file):
+
+    if os.path.isdir(file):
+        return sum(os.path.getsize(os.path.join(file, filename)) for filename in os.listdir(file))
+    return os.path.getsize(file)
+
+
+def entries(interim_path):
+
+    # Cache entries with their size and the time they were last used,
+    # most recently used first
+    results = []
+    for filename in os.listdir(interim_path):
+        name, extension = os.path.splitext(filename)
+        digest = name.rpartition('_')[2]
+        if len(digest) != 16 or extension not in ['.pkl', '.arrays']:
+            continue
+        file = os.path.join(interim_path, filename)
+        results.append({
+            'file': file,
+            'name': name,
+            'size': entry_size(file),
+            'used': os.path.getmtime(file),
+        })
+    return sorted(results, key=lambda entry: entry['used'], reverse=True)
+
+
+def remove(entry):
+
+    if os.path.isdir(entry['file']):
+        shutil.rmtree(entry['file'])
+    else:
+        os.remove(entry['file'])
+
+
+def evict(interim_path, size):
+
+    # Remove the least recently used entries until the cache fits in size
+    if size is None:
+        return []
+    removed = []
+    total = 0
+    # The most recent entry is always kept
+    for i, entry in enumerate(entries(interim_path)):
+        total += entry['size']
+        if i > 0 and total > size:
+            remove(entry)
+            removed.append(entry)
+    return removed
+
+
+def purge(interim_path, name=None, older=None):
+
+    # Remove all entries, or those starting with name or not used for older
+    # than the given number of days
+    removed = []
+    for entry in entries(interim_path):
+        if name is not None and not entry['name'].startswith(name):
+            continue
+        if older is not None and entry['used'] > time.time() - older * 86400:
+            continue
+        remove(entry)
+        removed.append(entry)
+    return removed
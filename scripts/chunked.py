@@ -0,0 +1,148 @@
+# The hourly stages of the pipeline a month at a time, for grids too fine
+# to hold the hourly (time, building, cell) demand of a whole year, eg the
+# 0.25 degree ERA5 grid (--grid 5).
+#
+# The daily demand and reference temperature are small and worked out for
+# the whole year as usual. The hourly demand is then made a month at a time,
+# twice:
+#  1. the population weighted total of each building over the year, which
+#     the scaling to the annual demand in demand.finishing needs,
+#  2. the scaled demand, its national total and its division by the COP of
+#     each sink and source, summed over the cells.
+# Only national series are kept from one month to the next. The results
+# are those of demand.finishing, demand.combine and cop.aggregate.
+
+import numpy as np
+import pandas as pd
+
+from . import demand
+from . import cop
+from .grid import cell_values
+from .misc import localization
+
+
+def month_chunks(index):
+
+    # (start, stop) positions of the months of a time index
+    months = index.year * 12 + index.month
+    starts = np.flatnonzero(np.diff(months)) + 1
+    bounds = np.concatenate([[0], starts, [len(index)]])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def hourly_demand(daily_heat, daily_water, reference_temperature, hourly_parameters, method, start, stop):
+
+    # The hourly space and water demand of the days from start up to stop
+    # as (time, building, cell) arrays.
+    # Upsampling needs at least two days so a shorter chunk is extended and
+    # cut back afterwards.
+    first = max(0, min(start, stop - 2))
+    last = max(stop, min(first + 2, len(daily_heat)))
+    reference = reference_temperature.rows(first, last)
+    classes = demand.temperature_classes_hourly(reference)
+    hourly_heat = demand.hourly_heat(daily_heat.rows(first, last), reference, hourly_parameters, classes)
+    hourly_water = demand.hourly_water(daily_water.rows(first, last), reference, hourly_parameters)
+
+    # For the other methods, we are calculating the hourly space heating.
+    if method == 'B':
+        hourly_space = (hourly_heat - hourly_water).clip(lower=0)
+    else:
+        hourly_space = hourly_heat.clip(lower=0)
+
+    hours = slice((start - first) * 24, (stop - first) * 24)
+    return hourly_space.values[hours], hourly_water.values[hours]
+
+
+def heat_pump_series(daily_heat, daily_water, reference_temperature, hourly_parameters, method,
+                     population, annual_space, annual_water, efficiency, spatial_cop, country,
+                     demand_country='GB'):
+
+    # The national heat demand as demand.combine and the national heat and
+    # heat pump power as cop.aggregate, from the daily demand a month at a
+    # time. spatial_cop is the lazy COP of cop.spatial_cop.
+    # The demand is localized to demand_country as demand.finishing.
+
+    cells = daily_heat.cells
+    buildings = daily_heat.labels('building')
+    population = cell_values(population, cells)
+    days = month_chunks(daily_heat.index)
+
+    # Hours of the demand and their localized times
+    hourly_index = pd.date_range(daily_heat.index[0], periods=24 * len(daily_heat), freq='60min')
+    rows, local_index = localization(hourly_index, demand_country)
+    counts = np.bincount(rows, minlength=len(hourly_index))
+
+    # First pass: population weighted totals of each building
+    print('Hourly demand totals by month ... ')
+    totals_space = np.zeros(len(buildings))
+    totals_water = np.zeros(len(buildings))
+    for start, stop in days:
+        space, water = hourly_demand(daily_heat, daily_water, reference_temperature, hourly_parameters, method, start, stop)
+        hours = counts[start * 24:stop * 24]
+        totals_space += np.einsum('t,tbc,c->b', hours, space, population)
+        totals_water += np.einsum('t,tbc,c->b', hours, water, population)
+
+    coefficients_space = demand.scaling_coefficients(
+        totals_space, population, demand.building_demand(annual_space, efficiency), buildings)
+    coefficients_water = demand.scaling_coefficients(
+        totals_water, population, demand.building_demand(annual_water, efficiency), buildings)
+
+    # The demand and the COP may be for different times eg localized to
+    # another country, so the heat pumps are worked out for all the times
+    # of either, by their positions in the hours of each
+    demand_index = local_index.tz_convert('utc')
+    cop_rows, cop_index = localization(spatial_cop.index, country)
+    cop_index = cop_index.tz_convert('utc')
+    index = demand_index.union(cop_index)
+    demand_rows = np.full(len(index), -1)
+    demand_rows[index.get_indexer(demand_index)] = rows
+    cop_positions = np.full(len(index), -1)
+    cop_positions[index.get_indexer(cop_index)] = cop_rows
+
+    sources = spatial_cop.labels('source')
+    sinks = spatial_cop.labels('sink')
+    heat = {sink: np.zeros(len(index)) for sink in sinks}
+    power = {sink: np.zeros((len(index), len(sources))) for sink in sinks}
+    space_hourly = np.zeros(len(hourly_index))
+    water_hourly = np.zeros(len(hourly_index))
+
+    # Second pass: scaled demand by month of the times
+    print('Hourly demand and heat pumps by month ... ')
+    for first, last in month_chunks(index):
+
+        chunk_rows = demand_rows[first:last]
+        valid = chunk_rows >= 0
+        if not valid.any():
+            continue
+        start = chunk_rows[valid].min() // 24
+        stop = chunk_rows[valid].max() // 24 + 1
+        space, water = hourly_demand(daily_heat, daily_water, reference_temperature, hourly_parameters, method, start, stop)
+
+        # National demand of the hours and the demand of each cell
+        space_hourly[start * 24:stop * 24] = space.reshape(len(space), -1) @ coefficients_space.ravel()
+        water_hourly[start * 24:stop * 24] = water.reshape(len(water), -1) @ coefficients_water.ravel()
+        space = np.einsum('tbc,bc->tc', space, coefficients_space)
+        water = np.einsum('tbc,bc->tc', water, coefficients_water)
+
+        # Demand and COP at the times of the chunk, NaN where missing
+        positions = np.where(valid, chunk_rows - start * 24, 0)
+        cop_chunk = cop_positions[first:last]
+        has_cop = cop_chunk >= 0
+        source = spatial_cop.source.values[np.where(has_cop, cop_chunk, 0)].astype('float32')
+        sink = spatial_cop.sink.values[np.where(has_cop, cop_chunk, 0)].astype('float32')
+
+        for i, sink_type in enumerate(sinks):
+            chunk_demand = (water if sink_type == 'water' else space)[positions]
+            chunk_demand[~valid] = np.nan
+            sink_cop = cop.cop_curve(source, sink[:, i:i + 1], spatial_cop.coefficients)[:, 0]
+            sink_cop[~has_cop] = np.nan
+            heat[sink_type][first:last] = np.nansum(chunk_demand, axis=-1)
+            # NaN where the times differ are skipped, as pandas
+            power[sink_type][first:last] = np.nansum(chunk_demand[:, np.newaxis, :] / sink_cop, axis=-1)
+
+    space = pd.Series(space_hourly[rows], index=demand_index)
+    water = pd.Series(water_hourly[rows], index=demand_index)
+    final_heat = pd.concat([space, water, space+water], axis=1, keys=['space', 'water', 'heat'])
+
+    heat_pump_heat, heat_pump_power = cop.national_frames(heat, power, index, sources, sinks)
+    return final_heat, heat_pump_heat, heat_pump_power
@@ -1,21 +1,17 @@
-
 import os
+import numpy as np
 import pandas as pd
 
-# from scripts.misc import localize
-# from scripts.misc import group_df_by_multiple_column_levels
-from .misc import group_df_by_multiple_column_levels,localize
+from .grid import GridSeries, align
 
 
 def source_temperature(temperature):
 
     celsius = temperature - 273.15
 
-    return pd.concat(
+    return GridSeries.stack(
         [celsius['air'], celsius['soil'] - 5, 0 * celsius['air'] + 10 - 5],
-        keys=['air', 'ground', 'water'],
-        names=['source', 'latitude', 'longitude'],
-        axis=1
+        'source', ['air', 'ground', 'water']
     )
 
 
@@ -23,73 +19,143 @@ def sink_temperature(temperature):
 
     celsius = temperature['air'] - 273.15
 
-    return pd.concat(
+    return GridSeries.stack(
         [-1 * celsius + 40, -.5 * celsius + 30, 0 * celsius + 50],
-        keys=['radiator', 'floor', 'water'],
-        names=['sink', 'latitude', 'longitude'],
-        axis=1
+        'sink', ['radiator', 'floor', 'water']
     )
 
 
-def spatial_cop(source, sink, cop_parameters):
+def cop_curve(source, sink, coefficients):
+
+    # COP of every sink and source from arrays of (time, source, cell) and
+    # (time, sink, cell) temperatures and the (power, source) coefficients
+    # of the quadratic COP curve, as a (time, sink, source, cell) array.
+    # Worked out in float32 like the temperatures.
+    source = source.astype('float32', copy=False)
+    sink = sink.astype('float32', copy=False)
+    delta_t = sink[:, :, np.newaxis, :] - source[:, np.newaxis, :, :]
+    delta_t = np.maximum(delta_t, np.float32(15))
+    c = coefficients[:, np.newaxis, :, np.newaxis]
+    cop = c[0] + c[1] * delta_t + c[2] * delta_t ** 2
+    return np.round(cop, 4)
+
+
+class LazyCOP:
+
+    # The COP of each sink worked out from the source and sink temperatures
+    # when it is selected, so the (time, sink, source, cell) array is never
+    # held in memory. Selects, localizes and reindexes as the
+    # GridSeries from spatial_cop, the time operations being applied to the
+    # temperatures.
+
+    def __init__(self, source, sink, coefficients):
+        self.source = source
+        self.sink = sink
+        self.coefficients = coefficients
+        self.levels = sink.levels + source.levels
+
+    @property
+    def index(self):
+        return self.source.index
+
+    @property
+    def cells(self):
+        return self.source.cells
+
+    def labels(self, name):
+        return dict(self.levels)[name]
+
+    def __len__(self):
+        return len(self.index)
+
+    def _times(self, function):
+        return LazyCOP(function(self.source), function(self.sink), self.coefficients)
+
+    def localize(self, country):
+        return self._times(lambda s: s.localize(country))
+
+    def tz_convert(self, tz):
+        return self._times(lambda s: s.tz_convert(tz))
+
+    def reindex(self, index):
+        return self._times(lambda s: s.reindex(index))
+
+    def __getitem__(self, label):
+
+        # The COP of a sink for every source
+        i = self.sink.labels('sink').index(label)
+        cop = cop_curve(self.source.values, self.sink.values[:, i:i + 1], self.coefficients)
+        return self.source.like(cop[:, 0])
 
-    def cop_curve(delta_t, source_type):
-        delta_t.clip(lower=15, inplace=True)
-        return sum(cop_parameters.loc[i, source_type] * delta_t ** i for i in range(3))
+    def evaluate(self):
+        return GridSeries(cop_curve(self.source.values, self.sink.values, self.coefficients),
+                          self.index, self.cells, self.levels)
 
-    source_types = source.columns.get_level_values('source').unique()
-    sink_types = sink.columns.get_level_values('sink').unique()
 
-    return pd.concat(
-        [pd.concat(
-            [cop_curve(sink[sink_type] - source[source_type], source_type)
-             for sink_type in sink_types],
-            keys=sink_types,
-            axis=1
-        ) for source_type in source_types],
-        keys=source_types,
-        axis=1,
-        names=['source', 'sink', 'latitude', 'longitude']
-    ).round(4).swaplevel(0, 1, axis=1)
+def spatial_cop(source, sink, cop_parameters, lazy=False):
 
+    # The coefficients of the COP curve by power and source
+    source_types = source.labels('source')
+    coefficients = cop_parameters.loc[range(3), source_types].values.astype('float32')
 
-def finishing(cop, demand_space, demand_water, country, correction=.85):
+    cop = LazyCOP(source, sink, coefficients)
+    if lazy:
+        return cop
+    return cop.evaluate()
+
+
+def aggregate(cop, demand_space, demand_water, country):
+
+    # The national heat and heat pump power by sink and source, shared by
+    # the COP and electricity outputs. For each sink the demand of every
+    # cell is divided by the COP of each source and summed over the cells.
+    # Returns the heat with sink columns and the power with source, sink
+    # columns.
 
     # Localize Timestamps (including daylight saving time correction) and convert to UTC
-    sinks = cop.columns.get_level_values('sink').unique()
-    cop = pd.concat(
-            [localize(cop[sink], country).tz_convert('utc') for sink in sinks],
-            keys=sinks, axis=1, names=['sink', 'source', 'latitude', 'longitude']
-    )
+    cop = cop.localize(country).tz_convert('utc')
 
     # Prepare demand values
-    demand_space = group_df_by_multiple_column_levels(demand_space, ['latitude', 'longitude'])
+    demand_space = demand_space.sum_categories()
+
+    demand_water = demand_water.sum_categories()
+
+    # The demand may be for different times eg localized to another country
+    cop, demand_space, demand_water = align(cop, demand_space, demand_water)
 
-    demand_water = group_df_by_multiple_column_levels(demand_water, ['latitude', 'longitude'])
- 
     # Spatial aggregation
-    sources = cop.columns.get_level_values('source').unique()
-    sinks = cop.columns.get_level_values('sink').unique()
+    sources = cop.labels('source')
+    sinks = cop.labels('sink')
+    heat = {}
+    power = {}
+    for sink in sinks:
+        demand = demand_water if sink == 'water' else demand_space
+        heat[sink] = demand.national().values
+        # NaN where the times differ are skipped, as pandas
+        power[sink] = np.nansum(demand.values[:, np.newaxis, :] / cop[sink].values, axis=-1)
+
+    return national_frames(heat, power, cop.index, sources, sinks)
+
+
+def national_frames(heat, power, index, sources, sinks):
+
+    # The heat with sink columns and the power with source, sink columns
+    # from arrays of the heat and of the (time, source) power of each sink
+    heat = pd.DataFrame(heat, index=index, columns=sinks)
     power = pd.concat(
-        [pd.concat(
-            [(demand_water / cop[sink][source]).sum(axis=1)
-             if sink == 'water' else
-             (demand_space / cop[sink][source]).sum(axis=1)
-             for sink in sinks],
-            keys=sinks, axis=1
-        ) for source in sources],
+        [pd.DataFrame({sink: power[sink][:, i] for sink in sinks}, index=index, columns=sinks)
+         for i, source in enumerate(sources)],
         keys=sources, axis=1
     )
-    heat = pd.concat(
-        [pd.concat(
-            [demand_water.sum(axis=1)
-             if sink == 'water' else
-             demand_space.sum(axis=1)
-             for sink in sinks],
-            keys=sinks, axis=1
-        ) for source in sources],
-        keys=sources, axis=1, names=['sink', 'source']
-    )
+
+    return heat, power
+
+
+def finishing(heat, power, correction=.85):
+
+    # Demand weighted national COP from the aggregated heat and power
+    sources = list(power.columns.get_level_values(0).unique())
+    heat = pd.concat([heat] * len(sources), keys=sources, axis=1)
     cop = heat / power
 
     # Correction and round
@@ -104,4 +170,3 @@ def finishing(cop, demand_space, demand_water, country, correction=.85):
     cop.columns = ['_'.join([level for level in col_name]) for col_name in cop.columns.values]
 
     return cop
-
@@ -2,24 +2,57 @@
 import numpy as np
 import pandas as pd
 
-# from scripts.misc import localize, upsample_df, group_df_by_multiple_column_levels
-from .misc import localize, upsample_df, group_df_by_multiple_column_levels
+from .grid import ScaledGridSeries, cell_values
+from .misc import localization
 
 
-def reference_temperature(temperature, nterms):
+def reference_temperature(temperature, nterms, previous=None):
 
     # Daily average
-    daily_average = temperature.groupby(pd.Grouper(freq='D')).mean().copy()
-
-    # Weighted mean
-    return sum([.5 ** i * daily_average.shift(i).fillna(method='bfill') for i in range(nterms)]) / \
-           sum([.5 ** i for i in range(nterms)])
+    daily_average = temperature.daily_mean()
+
+    # Weighted mean with weights .5 ** i for day i before
+    # Day i before the first day is taken as the first day (back fill)
+    # unless the daily averages of the days before are given as previous,
+    # eg from the previous year of a continuous series.
+    # The weighted sum is carried from day to day, adding the day and
+    # dropping the day nterms before, so any number of days costs one pass:
+    #   S(t) = x(t) + .5 S(t-1) - .5 ** nterms x(t - nterms)
+    x = daily_average.values.astype('float64')
+    start = 0
+    if previous is not None and len(previous) > 0:
+        start = len(previous)
+        x = np.concatenate([previous, x])
+    # Missing days take the next day's average (back fill) as every
+    # shifted day did before, rather than making all later days NaN
+    x = pd.DataFrame(x).bfill().values
+    weights = sum([.5 ** i for i in range(nterms)])
+    dropped = .5 ** nterms
+    weighted = np.empty_like(x)
+    total = x[0] * weights
+    weighted[0] = total
+    for t in range(1, len(x)):
+        total = x[t] + .5 * total - dropped * x[max(t - nterms, 0)]
+        weighted[t] = total
+
+    return daily_average.like(weighted[start:] / weights)
+
+
+def reference_state(temperature, nterms, previous=None):
+
+    # The daily averages of the last nterms days, that the reference
+    # temperature of the days after needs
+    x = temperature.daily_mean().values.astype('float64')
+    if previous is not None:
+        x = np.concatenate([previous, x])
+    return x[-nterms:]
 
 def hdd(temperature, population, base_temp=15.5):
-    celsius = temperature - 273.15    # The temperature input is in Kelvin
+    population = cell_values(population, temperature.cells)
+    celsius = temperature.values - 273.15    # The temperature input is in Kelvin
     heat = base_temp - celsius        # degree days with base temp
-    heat.clip(0, inplace=True)        # make sure its greater than zero.
-    hdd = heat.sum()                  # sum up the days
+    heat = heat.clip(0)               # make sure its greater than zero.
+    hdd = heat.sum(axis=0)            # sum up the days
     hdd = (hdd * population)/ population.sum()  # weight by population
     hdd = hdd.sum()          # sum up all the locations
     return hdd
@@ -32,7 +65,7 @@ def hdd_daily_heat(temperature, wind, all_parameters, base_temp=15.5):
 
         celsius = t - 273.15        # The temperature input is in Kelvin
         heat = base_temp - celsius  # degree days with base temp
-        heat.clip(0, inplace=True)  # make sure its greater than zero.
+        heat = heat.clip(0)         # make sure its greater than zero.
         return heat
 
     return daily(temperature, wind, all_parameters, heat_function)
@@ -67,17 +100,10 @@ def watson_daily_heat(temperature, wind, all_parameters):
 
     def heat_function(t, parameters):
 
-        def watson_heat(et):
-            if et < 14.1:
-                heat = -6.71 * et + 111
-                return heat
-            else:
-                heat = -1.21 * et + 33
-                return heat
-
         celsius = t - 273.15  # The temperature input is in Kelvin
         ND = 27               # millions of dwellings - 27 in 2015
-        return celsius.apply(watson_heat) * ND
+        heat = np.where(celsius < 14.1, -6.71 * celsius + 111, -1.21 * celsius + 33)
+        return heat * ND
 
     return daily(temperature, wind, all_parameters, heat_function)
 
@@ -94,7 +120,7 @@ def watson_daily_water(temperature, wind, all_parameters):
         # equation defined in Wastson et. al.
         heat = - 0.0458 * celsius + 1.8248
         # ensure its positive.
-        heat.clip(0, inplace=True)
+        heat = heat.clip(0)
 
         return heat * ND
 
@@ -114,9 +140,9 @@ def daily_heat(temperature, wind, all_parameters):
                 1 + (parameters['B'] / (celsius - 40)) ** parameters['C']
         ) + parameters['D']
 
-        linear = pd.DataFrame(
-            [parameters['m_{}'.format(i)] * celsius + parameters['b_{}'.format(i)] for i in ['s', 'w']]
-        ).max()
+        linear = np.maximum(
+            *[parameters['m_{}'.format(i)] * celsius + parameters['b_{}'.format(i)] for i in ['s', 'w']]
+        )
 
         return sigmoid + linear
 
@@ -134,7 +160,7 @@ def daily_water(temperature, wind, all_parameters):
 
         # Below 15 °C, the water heating demand is not defined and assumed to stay constant
         # this sets anything below 15 to 15.
-        celsius.clip(15, inplace=True)
+        celsius = celsius.clip(15)
 
         return parameters['m_w'] * celsius + parameters['b_w'] + parameters['D']
 
@@ -144,112 +170,147 @@ def daily_water(temperature, wind, all_parameters):
 def daily(temperature, wind, all_parameters, func):
 
     # All locations are separated by the average wind speed with the threshold 4.4 m/s
-    windy_locations = {
-        'normal': wind[wind <= 4.4].index,
-        'windy': wind[wind > 4.4].index
-    }
+    windy = cell_values(wind, temperature.cells) > 4.4
 
     buildings = ['SFH', 'MFH', 'COM']
 
-    return pd.concat(
-        [pd.concat(
-            [temperature[locations].apply(func, parameters=all_parameters[(building, windiness)])
-             for windiness, locations in windy_locations.items()],
-            axis=1
-        ) for building in buildings],
-        keys=buildings, names=['building', 'latitude', 'longitude'], axis=1
-    )
+    # Each parameter as a (building, cell) array with the normal or windy
+    # value of the cell, so the heat functions evaluate every building and
+    # cell in one go
+    parameters = {
+        name: np.array([np.where(windy,
+                                 all_parameters.loc[name, (building, 'windy')],
+                                 all_parameters.loc[name, (building, 'normal')])
+                        for building in buildings])
+        for name in all_parameters.index
+    }
+
+    # Temperature as (time, 1, cell) to broadcast against the buildings
+    t = temperature.values[:, np.newaxis, :].astype('float64')
+    shape = (len(temperature), len(buildings), len(temperature.cells))
+    values = np.array(np.broadcast_to(func(t, parameters), shape))
+
+    return temperature.like(values, levels=[('building', buildings)])
 
 
-def hourly_heat(daily_df, temperature, parameters):
+# Temperature classes of the hourly profiles
+temperature_classes = [-15, -10, -5, 0, 5, 10, 15, 20, 25, 30]
+
+
+def profile_tables(parameters, buildings):
+
+    # The hourly profiles as one array indexed by
+    # (building, weekday, hour, temperature class) where weekday 0 is Sunday.
+    # Only commercial buildings depend on the weekday.
+    tables = np.full((len(buildings), 7, 24, len(temperature_classes)), np.nan)
+    for b, building in enumerate(buildings):
+        profile = parameters[building][[str(c) for c in temperature_classes]]
+        if building == 'COM':
+            weekdays = profile.index.get_level_values(0).astype(int)
+            hours = np.array([int(time[:2]) for time in profile.index.get_level_values(1)])
+            tables[b, weekdays, hours] = profile.values
+        else:
+            hours = np.array([int(time[:2]) for time in profile.index])
+            tables[b][:, hours] = profile.values
+    return tables
+
+
+def temperature_classes_hourly(temperature):
 
     # According to BGW 2006, temperature classes are derived from the temperature data
-    # This is re-sampled to a 60-min-resolution and passed to the general hourly function
+    # This is re-sampled to a 60-min-resolution
     # MP: For each latitude,lognitude in the grid classes contains the 
     #     temperature in one of the 5 degree bands 5,10,15 etc to look up
     #     the hourly factors to multiply by.
+    #     The classes are kept as their position 0-9 in temperature_classes.
 
-    classes = upsample_df(
-        (np.ceil(((temperature - 273.15) / 5).astype('float64')) * 5).clip(lower=-15, upper=30),
-        '60min'
-    ).astype(int).astype(str)
+    classes = temperature.like(
+        ((np.ceil(((temperature.values - 273.15) / 5).astype('float64')) * 5).clip(-15, 30) + 15) // 5
+    ).upsample('60min')
 
-    return hourly(daily_df, classes, parameters)
+    return classes.values.astype('int8')
 
 
-def hourly_water(daily_df, temperature, parameters):
+def hourly_heat(daily_df, temperature, parameters, classes=None):
 
-    # For water heating, the highest temperature classes '30' is chosen
-    # This is re-sampled to a 60-min-resolution and passed to the general hourly function
+    # The temperature classes are passed to the general hourly function
+    # They may be given to share them between methods
 
-    classes = upsample_df(
-        pd.DataFrame(30, index=temperature.index, columns=temperature.columns),
-        '60min'
-    ).astype(int).astype(str)
+    if classes is None:
+        classes = temperature_classes_hourly(temperature)
 
     return hourly(daily_df, classes, parameters)
 
 
-def hourly(daily_df, classes, parameters):
+def hourly_water(daily_df, temperature, parameters):
 
-    def hourly_factors(building):
+    # For water heating, the highest temperature classes '30' is chosen
+    # This is passed to the general hourly function as a single class for
+    # all the grid cells
 
-        # This function selects hourly factors from BGW 2006 by time and temperature class
-        slp = pd.DataFrame(index=classes.index, columns=classes.columns)
+    return hourly(daily_df, temperature_classes.index(30), parameters)
 
-        # Time includes the hour of the day
-        times = classes.index.map(lambda x: x.strftime('%H:%M'))
-        # For commercial buildings, time additionally includes the weekday
-        if building == 'COM':
-            weekdays = classes.index.map(lambda x: int(x.strftime('%w')))
-            times = list(zip(weekdays, times))
 
-        for column in classes.columns:
-            slp[column] = parameters[building].lookup(times, classes.loc[:, column])
+def hourly(daily_df, classes, parameters):
+
+    # Hourly factors from BGW 2006 by time and temperature class, selected
+    # for every hour, building and cell by one gather from the profile tables.
+    # classes is a (time, cell) array of class positions, or a single class.
 
-        return slp
+    buildings = daily_df.labels('building')
+    daily_hourly = daily_df.upsample('60min')
+    tables = profile_tables(parameters, buildings)
 
-    buildings = daily_df.columns.get_level_values('building').unique()
+    # Weekday (0 is Sunday) and hour of each time
+    index = daily_hourly.index
+    weekdays = ((index.dayofweek.values + 1) % 7)[:, np.newaxis, np.newaxis]
+    hours = index.hour.values[:, np.newaxis, np.newaxis]
+    building = np.arange(len(buildings))[np.newaxis, :, np.newaxis]
+    if np.ndim(classes) == 2:
+        classes = classes[:, np.newaxis, :]
 
-    results = pd.concat(
-        [upsample_df(daily_df, '60min')[building] * hourly_factors(building) for building in buildings],
-        keys=buildings, names=['building', 'latitude', 'longitude'], axis=1
-#       keys=buildings, names=['building', 'country', 'latitude', 'longitude'], axis=1
-    )
+    slp = tables[building, weekdays, hours, classes]
 
-    return results
+    return daily_hourly.like(daily_hourly.values * slp)
 
 
-def finishing(df, population, building_database, efficiency=0.9, country='GB'):
+def building_demand(building_database, efficiency=0.9):
 
     # Single- and multi-family houses are aggregated assuming a ratio of 70:30
     # Transforming to heat demand assuming an average conversion efficiency of 0.9
-    building_database = {
+    return {
         'SFH': efficiency * .7 * building_database['residential'],
         'MFH': efficiency * .3 * building_database['residential'],
         'COM': efficiency * building_database['commercial']
     }
 
-    results = []
 
-    # Localize Timestamps (including daylight saving time correction)
-    df_country = localize(df, country)
+def scaling_coefficients(totals, population, building_database, buildings):
 
-    absolute = []
-    for building_type, building_data in building_database.items():
+    # Weighting by population and scaling to the building database folded
+    # into one coefficient of each building and cell, from the population
+    # weighted total of each building
+    return np.array([
+        population * 1000000 / totals[b] * building_database[building]
+        for b, building in enumerate(buildings)
+    ])
 
-        # Weighting
-        df_cb = df_country[building_type] * population
 
-        # Scaling to 1 TWh/a
-        years = df_cb.index.year.unique()
-        factor = 1000000 / df_cb.sum().sum() * len(years)
+def finishing(df, population, building_database, efficiency=0.9, country='GB'):
+
+    building_database = building_demand(building_database, efficiency)
+
+    # Localize Timestamps (including daylight saving time correction)
+    rows, index = localization(df.index, country)
+    population = cell_values(population, df.cells)
 
-        # Scaling to building database
-        factors = 1000000 / df_cb.sum().sum() * building_data
-        absolute.append(df_cb * factors)
+    # The total of each building comes from the unweighted values and the
+    # number of times each row is used after localizing
+    buildings = df.labels('building')
+    totals = np.einsum('t,tbc,c->b', np.bincount(rows, minlength=len(df)), df.values, population)
+    coefficients = scaling_coefficients(totals, population, building_database, buildings)
 
-    country_results = pd.concat(absolute, axis=1, keys=building_database.keys(), names=['building_type', 'latitude', 'longitude'])
+    country_results = ScaledGridSeries(df, coefficients, rows, index, [('building_type', buildings)])
 
     return country_results.tz_convert('utc')
 
@@ -257,8 +318,8 @@ def finishing(df, population, building_database, efficiency=0.9, country='GB'):
 def combine(space, water):
     
     # Spatial aggregation
-    space = space.sum(axis=1)
-    water = water.sum(axis=1)
+    space = space.national()
+    water = water.national()
 
     df = pd.concat([space, water, space+water], axis=1, keys=['space', 'water', 'heat'])
 
@@ -0,0 +1,268 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+from .misc import localization, upsample, upsample_df
+
+# A time series on the weather grid held as one dense array of shape
+# (time, category..., cell), with the time index, the labels of each
+# category level (parameter, building, source, sink ...) and the
+# (latitude, longitude) MultiIndex of the cells.
+# This replaces DataFrames with (category..., latitude, longitude) columns
+# inside the pipeline: selecting a category is a view, arithmetic is plain
+# numpy, and pandas is only used at the output via to_frame().
+
+
+def cell_values(s, cells):
+
+    # Values of a Series indexed by (latitude, longitude) in the cell order
+    if not isinstance(s.index, pd.MultiIndex):
+        s = pd.Series(s.values, index=pd.MultiIndex.from_tuples(list(s.index)))
+    return s.reindex(cells).values
+
+
+def align(*series):
+
+    # Reindex GridSeries to the union of their time indexes, as pandas
+    # arithmetic would, missing times being NaN
+    index = series[0].index
+    for s in series[1:]:
+        if not s.index.equals(index):
+            index = index.union(s.index)
+    return [s if s.index.equals(index) else s.reindex(index) for s in series]
+
+
+class GridSeries:
+
+    # numpy scalars and arrays defer to the operators below
+    __array_ufunc__ = None
+
+    def __init__(self, values, index, cells, levels=()):
+        self.values = values
+        self.index = index
+        self.cells = cells
+        # list of (name, labels) for each category axis
+        self.levels = list(levels)
+
+    @classmethod
+    def from_frame(cls, df):
+
+        # The last two column levels are latitude and longitude, the others
+        # are the categories. Every category must cover the same cells.
+        names = df.columns.names[:-2]
+        levels = [(name, list(df.columns.get_level_values(name).unique())) for name in names]
+        cells = df.columns.droplevel(list(names)).unique() if names else df.columns
+        cells = pd.MultiIndex.from_tuples(list(cells), names=('latitude', 'longitude'))
+
+        # Columns in the order (category..., cell)
+        columns = [labels + cell
+                   for labels in itertools.product(*[labels for name, labels in levels])
+                   for cell in cells]
+        df = df.reindex(columns=pd.MultiIndex.from_tuples(columns, names=df.columns.names))
+        sizes = [len(labels) for name, labels in levels]
+        values = df.values.reshape([len(df.index)] + sizes + [len(cells)])
+
+        return cls(values, df.index, cells, levels)
+
+    @classmethod
+    def stack(cls, series, name, labels):
+
+        # New leading category level from a list of GridSeries
+        values = np.stack([s.values for s in series], axis=1)
+        first = series[0]
+        return cls(values, first.index, first.cells, [(name, list(labels))] + first.levels)
+
+    def like(self, values, index=None, levels=None):
+
+        # A GridSeries on the same cells with new values
+        return GridSeries(values,
+                          self.index if index is None else index,
+                          self.cells,
+                          self.levels if levels is None else levels)
+
+    def labels(self, name):
+        return dict(self.levels)[name]
+
+    def __getitem__(self, label):
+
+        # Select a label of the first category level
+        name, labels = self.levels[0]
+        return self.like(self.values[:, labels.index(label)], levels=self.levels[1:])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        levels = ', '.join('{}: {}'.format(name, labels) for name, labels in self.levels)
+        return 'GridSeries {} times from {} to {}, {} cells, {}'.format(
+            len(self.index), self.index[0], self.index[-1], len(self.cells), levels)
+
+    def _other(self, other):
+        return other.values if isinstance(other, GridSeries) else other
+
+    def __add__(self, other):
+        return self.like(self.values + self._other(other))
+
+    def __radd__(self, other):
+        return self.like(self._other(other) + self.values)
+
+    def __sub__(self, other):
+        return self.like(self.values - self._other(other))
+
+    def __rsub__(self, other):
+        return self.like(self._other(other) - self.values)
+
+    def __mul__(self, other):
+        return self.like(self.values * self._other(other))
+
+    def __rmul__(self, other):
+        return self.like(self._other(other) * self.values)
+
+    def __truediv__(self, other):
+        return self.like(self.values / self._other(other))
+
+    def __pow__(self, other):
+        return self.like(self.values ** self._other(other))
+
+    def __neg__(self):
+        return self.like(-self.values)
+
+    def clip(self, lower=None, upper=None):
+        return self.like(np.clip(self.values, lower, upper))
+
+    def round(self, decimals=0):
+        return self.like(np.round(self.values, decimals))
+
+    def sum_cells(self):
+
+        # Spatial aggregation, an array of (time, category...)
+        return self.values.sum(axis=-1)
+
+    def sum_categories(self):
+
+        # Sum over all the category levels, leaving (time, cell)
+        values = self.values.reshape((len(self.index), -1, len(self.cells))).sum(axis=1)
+        return self.like(values, levels=[])
+
+    def national(self):
+
+        # Sum over categories and cells as a Series, skipping NaN as pandas
+        return pd.Series(np.nansum(self.to_2d(), axis=1), index=self.index)
+
+    def mean_cells(self):
+        return pd.Series(self.values.mean(axis=-1), index=self.index)
+
+    def to_2d(self):
+        return self.values.reshape(len(self.index), -1)
+
+    def to_frame(self):
+
+        # DataFrame with (category..., latitude, longitude) column MultiIndex
+        names = [name for name, labels in self.levels]
+        columns = [labels + cell
+                   for labels in itertools.product(*[labels for name, labels in self.levels])
+                   for cell in self.cells]
+        columns = pd.MultiIndex.from_tuples(columns, names=names + ['latitude', 'longitude'])
+        return pd.DataFrame(self.to_2d(), index=self.index, columns=columns)
+
+    def _from_2d(self, df):
+        return self.like(df.values.reshape((len(df.index),) + self.values.shape[1:]), index=df.index)
+
+    def daily_mean(self):
+        df = pd.DataFrame(self.to_2d(), index=self.index)
+        return self._from_2d(df.groupby(pd.Grouper(freq='D')).mean())
+
+    def upsample(self, resolution):
+
+        # Repeat the rows without going through a DataFrame where possible
+        result = upsample(self.values, self.index, resolution)
+        if result is None:
+            df = pd.DataFrame(self.to_2d(), index=self.index)
+            return self._from_2d(upsample_df(df, resolution))
+        values, index = result
+        return self.like(values, index=index)
+
+    def localize(self, country):
+
+        # Localize Timestamps (including daylight saving time correction)
+        rows, index = localization(self.index, country)
+        return self.like(self.values[rows], index=index)
+
+    def rows(self, start, stop):
+
+        # The times from start up to stop by position
+        return self.like(self.values[start:stop], index=self.index[start:stop])
+
+    def select_cells(self, cells):
+
+        # The series on some of its cells, in the order given
+        positions = self.cells.get_indexer(cells)
+        values = np.ascontiguousarray(np.take(self.values, positions, axis=-1))
+        return GridSeries(values, self.index, self.cells[positions], self.levels)
+
+    def reindex(self, index):
+
+        # Rows for a new time index, NaN where a time is missing
+        positions = self.index.get_indexer(index)
+        values = self.values[positions].astype('float64')
+        values[positions < 0] = np.nan
+        return self.like(values, index=index)
+
+    def tz_convert(self, tz):
+        return self.like(self.values, index=self.index.tz_convert(tz))
+
+
+class ScaledGridSeries:
+
+    # A GridSeries multiplied by a coefficient for each category and cell,
+    # with its rows selected by a gather, neither being applied until the
+    # values are needed. National and cell totals are worked out from the
+    # unscaled values so the scaled (time, category..., cell) array is only
+    # made by evaluate().
+
+    def __init__(self, series, coefficients, rows=None, index=None, levels=None):
+        self.series = series
+        self.coefficients = coefficients
+        self.rows = np.arange(len(series.index)) if rows is None else rows
+        self.index = series.index if index is None else index
+        self.levels = series.levels if levels is None else levels
+
+    @property
+    def cells(self):
+        return self.series.cells
+
+    def labels(self, name):
+        return dict(self.levels)[name]
+
+    def __len__(self):
+        return len(self.index)
+
+    def _like(self, rows, index):
+        return ScaledGridSeries(self.series, self.coefficients, rows, index, self.levels)
+
+    def localize(self, country):
+
+        # Localize Timestamps (including daylight saving time correction)
+        rows, index = localization(self.index, country)
+        return self._like(self.rows[rows], index)
+
+    def tz_convert(self, tz):
+        return self._like(self.rows, self.index.tz_convert(tz))
+
+    def sum_categories(self):
+
+        # Sum over all the category levels, leaving (time, cell)
+        values = self.series.values.reshape((len(self.series.index), -1, len(self.cells)))
+        coefficients = self.coefficients.reshape((-1, len(self.cells)))
+        values = np.einsum('tkc,kc->tc', values, coefficients)
+        return GridSeries(values[self.rows], self.index, self.cells)
+
+    def national(self):
+
+        # Sum over categories and cells as a Series
+        values = self.series.to_2d() @ self.coefficients.ravel()
+        return pd.Series(values[self.rows], index=self.index)
+
+    def evaluate(self):
+        values = self.series.values[self.rows] * self.coefficients
+        return GridSeries(values, self.index, self.cells, self.levels)
@@ -1,36 +1,100 @@
 
 import pytz
+import hashlib
+import numpy as np
 import pandas as pd
 
 
-def localize(df, country, ambiguous=None):
+# Localisations already worked out, by time zone and index
+_localizations = {}
+
+
+def timezone(country):
 
     # use GB for NI or UK
     if country=='NI' or country=='UK':
         country='GB'
+    return pytz.country_timezones[country][0]
+
+
+def localization(index, country):
+
+    # The rows and local times of a naive index in the country's time zone,
+    # correcting for daylight saving time: times that do not exist are
+    # dropped and times that exist twice are duplicated, in time order.
+    # Worked out once per index and time zone.
+    zone = timezone(country)
+    times = index.asi8
+    key = (zone, index.name, hashlib.sha1(times.tobytes()).hexdigest())
+    if key in _localizations:
+        return _localizations[key]
+
+    # Each time localised as summer time and as winter time where ambiguous
+    n = len(index)
+    summer = index.tz_localize(zone, ambiguous=np.ones(n, dtype=bool), nonexistent='NaT')
+    winter = index.tz_localize(zone, ambiguous=np.zeros(n, dtype=bool), nonexistent='NaT')
+    exists = ~summer.isna()
+    twice = exists & (summer.asi8 != winter.asi8)
 
-    # The exceptions below correct for daylight saving time
-    try:
-        df.index = df.index.tz_localize(pytz.country_timezones[country][0], ambiguous=ambiguous)
-        return df
+    rows = np.concatenate([np.flatnonzero(exists), np.flatnonzero(twice)])
+    utc = np.concatenate([summer.asi8[exists], winter.asi8[twice]])
+    order = np.argsort(utc, kind='stable')
 
-    # Delete values that do not exist because of daylight saving time
-    except pytz.NonExistentTimeError as err:
-        return localize(df.loc[df.index != err.args[0], ], country)
+    result = (rows[order], pd.DatetimeIndex(utc[order], tz='UTC', name=index.name).tz_convert(zone))
+    _localizations[key] = result
+    return result
 
-    # Duplicate values that exist twice because of daylight saving time
-    except pytz.AmbiguousTimeError as err:
-        sargs = err.args[0].split(" ")
-        tstmp = sargs[5] + ' ' + sargs[6]
-#       print(tstmp)
-        idx = pd.Timestamp(tstmp)
-        unambiguous_df = localize(df.loc[df.index != idx, ], country)
-        ambiguous_df = localize(df.loc[[idx, idx], ], country, ambiguous=[True, False])
-        return unambiguous_df.append(ambiguous_df).sort_index()
+
+def localize(df, country):
+
+    # Localize Timestamps (including daylight saving time correction)
+    # The rows of a DataFrame or Series are gathered in one copy
+    rows, index = localization(df.index, country)
+    df = df.iloc[rows]
+    df.index = index
+    return df
+
+
+def upsample(values, index, resolution):
+
+    # The low-resolution values are applied to all high-resolution values up to the next low-resolution value
+    # In particular, the last low-resolution value is extended up to where the next low-resolution value would be
+    # Each row of values is repeated for the number of high-resolution steps
+    # up to the next row, giving the rows in one allocation, and the new
+    # index is a regular range from the first time.
+    # Returns None if the times are not on the high-resolution steps, for
+    # the caller to fall back on resampling.
+
+    step = pd.Timedelta(resolution).value
+    times = index.asi8
+    if len(times) < 2 or index.tz is not None:
+        return None
+
+    # Number of high-resolution steps from each time to the next, the last
+    # time extended by the original frequency
+    ends = np.append(times[1:], 2 * times[-1] - times[-2])
+    steps = ends - times
+    if (times[0] % step) or (steps % step).any() or (steps <= 0).any():
+        return None
+    counts = steps // step
+
+    values = np.repeat(values, counts, axis=0)
+    index = pd.date_range(index[0], periods=len(values), freq=resolution, name=index.name)
+    return values, index
 
 
 def upsample_df(df, resolution):
 
+    result = upsample(df.values, df.index, resolution)
+    if result is None:
+        return resample_df(df, resolution)
+
+    values, index = result
+    return pd.DataFrame(values, index=index, columns=df.columns)
+
+
+def resample_df(df, resolution):
+
     # The low-resolution values are applied to all high-resolution values up to the next low-resolution value
     # In particular, the last low-resolution value is extended up to where the next low-resolution value would be
 
@@ -49,11 +113,3 @@ def upsample_df(df, resolution):
     df.drop(df.index[-1], inplace=True)
 
     return df
-
-
-def group_df_by_multiple_column_levels(df, column_levels):
-
-    df = df.groupby(df.columns.droplevel(list(set(df.columns.names) - set(column_levels))), axis=1).sum()
-    df.columns = pd.MultiIndex.from_tuples(df.columns, names=column_levels)
-
-    return df
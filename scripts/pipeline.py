@@ -0,0 +1,481 @@
+# The heat demand pipeline of heat_series.py as a function, so that one
+# process can do many runs.
+#
+#   from scripts import pipeline
+#   context = pipeline.Context()
+#   for year in range(2010, 2019):
+#       config = pipeline.config(2018, year, country='GB', method='all')
+#       pipeline.run(config, context)
+#       context.forget(year)
+#
+# A config has the options of the heat_series.py command line. The Context
+# keeps what does not change between runs in memory: the population
+# mappings, the wind, the temperature and the parameter files. They are kept
+# until context.forget(year) or context.forget(year, country) drops those of
+# a weather year, which a loop over many years should do once it is done
+# with each year.
+
+# Python modules
+import os
+import json
+import argparse
+import pandas as pd
+import matplotlib.pyplot as plt
+
+# Custom scripts
+from . import download
+from . import read
+from . import preprocess
+from . import demand
+from . import cop
+from . import write
+from . import plot as plots
+from . import electric
+from . import cache
+from . import chunked
+from .misc import localize
+
+methods = { "B" : "BDEW", "W" : "Watson", "S" : "HDD 15.5", "H" : "HDD 12.8" }
+method_string = json.dumps(methods)
+
+all_profiles = ['bdew', 'flat', 'rhpp']
+
+all_countries = ['AT', 'BE', 'BG', 'CZ', 'DE', 'FR', 'GB', 'UK', 'NI', 'HR',
+                 'HU', 'IE', 'LU', 'NL', 'PL', 'RO', 'SI', 'SK']
+
+
+def parser():
+
+    # command line options, also the options of a config
+
+    parser = argparse.ArgumentParser(description='Generate heat and COP time series.')
+    parser.add_argument('ref', type=int, help='Reference year')
+    parser.add_argument('weather', type=int, help='Weather year')
+    parser.add_argument('--version', action="store", dest="version", help='Version - subdirectory to store output in, defaults to year', default=None )
+    parser.add_argument('--method', action="store", dest="method", help='Heat demand calculation method: ' + method_string + ', a comma separated list of them or all. Each method has its own output file.', default='S' )
+    parser.add_argument('--grid', action="store", dest="grid", help='Grid I=0.75,0.75; 5=0.25,0.25 ', default='I' )
+    parser.add_argument('--profile', action="store", dest="profile", help='Hourly profile one of:' + ','.join(all_profiles) + ', a comma separated list of them or all. Each profile has its own output file.', default='bdew' )
+    parser.add_argument('--adverse', action="store", dest="adverse", help='UK Met office adverse weather scenario file in the adverse sub director within the weather directory', default=None)
+    parser.add_argument('--country', action="store", dest="country", help='Country one of:'+','.join(all_countries) + ', a comma separated list of them or all. The weather is read once for all of them.', default='GB' )
+    parser.add_argument('--years', action="store", dest="years", help='Several weather years, first-last or a comma separated list, instead of the weather year', default=None)
+    parser.add_argument('--continuous', action="store_true", dest="continuous", help='With --years write one continuous series, a year at a time in one process, carrying the reference temperature over from year to year', default=False)
+    parser.add_argument("--processes", type=int, action="store", dest="processes", help="Number of processes to run several countries or weather years in.", default=1)
+    parser.add_argument('--europe', action="store_true", dest="europe", help='Map the population of all countries in one pass and slice out the country', default=False)
+    parser.add_argument('--region', action="store", dest="region", help='Only part of the country: one of ' + ','.join(preprocess.regions) + ', a box north,west,south,east or a csv file of longitude,latitude polygon vertices', default=None)
+    parser.add_argument('--nopop', action="store_true", dest="no_population", help='No weighting by population', default=False)
+    parser.add_argument('--plot', action="store_true", dest="plot", help='Show diagnostic plots', default=False)
+    parser.add_argument('--climate', action="store_true", dest="climate", help='Account for climate change', default=False)
+    parser.add_argument('--electric', action="store_true", dest="electric", help='Generate an eletricity time series', default=False)
+    parser.add_argument('--interim', action="store_true", dest="interim", help='Use ERA-Interim', default=False)
+    parser.add_argument("--tdays", type=int, action="store", dest="temp_days", help="Number of previous days temperature to use (1 to just use current day).", default=1)
+    # This is 1.0 because I am supplying annual heat demand for the country as
+    # opposed to fuel energy.
+    parser.add_argument("--eta", type=float, action="store", dest="efficiency", help="Factor to multiple by annual demand by to take account of efficiency.", default=1.0)
+    parser.add_argument("--ceta", type=float, action="store", dest="ceta", help="Factor to multiple COP demand by to take account of real world.", default=0.85)
+    parser.add_argument("--cache-size", type=float, action="store", dest="cache_size", help="Size limit in GB of the intermediate results in the interim directory, least recently used are removed first.", default=cache.max_size / 1024 ** 3)
+    parser.add_argument('--chunked', action="store_true", dest="chunked", help='Work out the hourly demand and heat pumps a month at a time, for fine grids such as 5', default=False)
+    parser.add_argument('--debug', action="store_true", dest="debug", help='Debug mode 2 days only', default=False)
+    return parser
+
+
+def config(ref, weather, **options):
+
+    # A config with the command line defaults for the options not given
+    args = parser().parse_args([str(ref), str(weather)])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise ValueError('Unknown option {}'.format(name))
+        setattr(args, name, value)
+    return args
+
+
+class Context:
+
+    # State shared between runs. Everything is kept by the options it
+    # depends on, so runs for other countries, years or grids add to it.
+
+    def __init__(self, home_path=None):
+        if home_path is None:
+            home_path = os.path.realpath('.')
+        self.home_path = home_path
+        self.input_path = os.path.join(home_path, 'input')
+        self.interim_path = os.path.join(home_path, 'interim')
+        self.populations = {}
+        self.winds = {}
+        self.temperatures = {}
+        self.profiles = {}
+        self.parameters = {}
+
+    def population(self, args, country, year):
+
+        key = (country, args.adverse, args.interim, year, args.grid, args.europe, args.region)
+        if key not in self.populations:
+
+            # the population grid determines which weather grid squares belong to
+            # a country
+
+            download.population(self.input_path)
+
+            print('Mapping population ... ')
+
+            mapped_population = preprocess.map_population(self.input_path, self.interim_path, country, args.adverse, args.interim, year, args.grid, args.plot, args.europe)
+
+            # Restrict to part of the country
+
+            if args.region:
+                mapped_population = preprocess.select_region(mapped_population, preprocess.region(args.region))
+                print('Region {} has {} grid points'.format(args.region, len(mapped_population)))
+
+            self.populations[key] = mapped_population
+
+        return self.populations[key]
+
+    def wind_key(self, args, country, year):
+        return (country, args.adverse, args.interim, year, args.grid, args.europe, args.region)
+
+    def temperature_key(self, args, country, year):
+        return (country, args.adverse, year, args.grid, args.europe, args.region)
+
+    def preload_weather(self, args, country, year, temperature, wind):
+
+        # Weather read elsewhere, eg for several countries at once
+        self.temperatures[self.temperature_key(args, country, year)] = temperature
+        self.winds[self.wind_key(args, country, year)] = wind
+
+    def wind(self, args, country, year, mapped_population):
+
+        key = self.wind_key(args, country, year)
+        if key not in self.winds:
+            print('Processing wind ... ')
+            self.winds[key] = preprocess.wind(self.input_path, mapped_population, args.interim, year, args.grid, args.plot, args.adverse)
+        return self.winds[key]
+
+    def temperature(self, args, country, year, mapped_population):
+
+        key = self.temperature_key(args, country, year)
+        if key not in self.temperatures:
+            print('Processing temp ... ')
+            self.temperatures[key] = preprocess.temperature(self.input_path, year, mapped_population, self.interim_path, args.adverse, country, args.grid, 6)
+        return self.temperatures[key]
+
+    def forget(self, year, country=None):
+
+        # Drop the population, wind and temperature of a weather year, of
+        # all countries or of one
+        for store in [self.populations, self.winds, self.temperatures]:
+            for key in [key for key in store if year in key and country in (None, key[0])]:
+                del store[key]
+
+    def hourly_parameters(self, profile):
+
+        if profile not in self.profiles:
+            self.profiles[profile] = read.hourly_parameters(self.input_path, profile)
+        return self.profiles[profile]
+
+    def read(self, name, *options):
+
+        # Parameter files from the read module by function name and options
+        key = (name,) + options
+        if key not in self.parameters:
+            self.parameters[key] = getattr(read, name)(self.input_path, *options)
+        return self.parameters[key]
+
+
+def download_weather(input_path, args, year):
+
+    # weather
+
+    if args.adverse:
+        print('Using Adverse weather scenario file')
+    else:
+
+        if args.interim:
+            print('Using weather data from ERA-Interim')
+            if "ECMWF_API_URL" not in os.environ or "ECMWF_API_KEY" not in os.environ or "ECMWF_API_EMAIL" not in os.environ:
+                raise ValueError("Environment variables ECMWF_API_URL, ECMWF_API_KEY and ECMWF_API_EMAIL must be set to use ERA-Interim")
+            download.wind(input_path)
+            download.temperatures(input_path, year, year)
+        else:
+            print('Using weather data from ERA5')
+            download.weather_era5(input_path, year, 6, args.grid)
+            download.wind_era5(input_path,year, args.grid)
+
+
+def run(args, context=None, stream=None):
+
+    # Generate the heat demand, COP and electricity time series of a config,
+    # returning the output file of each (method, profile)
+    # stream is given to run one year of a continuous series of several
+    # years. It holds the weather years for the output name, the daily
+    # temperatures the reference temperature needs from the year before and
+    # whether to append to the output, and is updated for the next year.
+
+    if context is None:
+        context = Context()
+
+    ref = args.ref
+    year = args.weather
+    weather_name = str(year) if stream is None else stream['name']
+    if args.version:
+        version = args.version
+    else:
+        version = weather_name
+    if args.method == 'all':
+        method_list = list(methods)
+    else:
+        method_list = args.method.split(',')
+    for method in method_list:
+        if method not in methods:
+            raise ValueError('Method {} is not one of {}'.format(method, method_string))
+    if args.profile == 'all':
+        profile_list = all_profiles
+    else:
+        profile_list = args.profile.split(',')
+    country = args.country
+    grid = args.grid
+
+    print('Options- weather year: {} reference year: {} method: {} profile: {} country: {} grid: {} '.format( year, ref, ','.join(methods[method] for method in method_list), ','.join(profile_list), country, grid))
+
+    input_path = context.input_path
+    interim_path = context.interim_path
+    output_path = os.path.join(context.home_path, 'output', version)
+
+    for path in [input_path, interim_path, output_path]:
+        os.makedirs(path, exist_ok=True)
+    cache.max_size = args.cache_size * 1024 ** 3
+
+    def output_file_name(method, profile):
+        output_name = '{}Ref{}Weather{}{}-{}{}'.format(country,str(ref),weather_name,grid,method,profile)
+        if args.climate:
+            output_name += 'C'
+        if args.region:
+            # The name of a polygon file or the whole box, whose decimal
+            # points are not an extension
+            region_name = args.region
+            if os.path.isfile(args.region):
+                region_name = os.path.splitext(os.path.basename(args.region))[0]
+            output_name += 'R' + region_name.replace(',', '_')
+        #print('output_name {}'.format(output_name))
+        output_file = os.path.join(output_path, output_name + '.csv')
+        if args.adverse:
+            if len(method_list) > 1 or len(profile_list) > 1:
+                output_file = os.path.join(output_path, args.adverse + '-' + method + profile + '.csv')
+            else:
+                output_file = os.path.join(output_path, args.adverse + '.csv')
+        return output_file
+
+    download_weather(input_path, args, year)
+
+    mapped_population = context.population(args, country, year)
+
+    # if no population weighting,
+    # set the population values all to the same thing so we get no weighting.
+
+    if args.no_population:
+        mapped_population = mapped_population * 0.0 + 1.0
+        print('No weighting by population')
+    else:
+        print('Weighting by population')
+
+    wind = context.wind(args, country, year, mapped_population)
+    if args.plot:
+        plt.show()
+
+    temperature = context.temperature(args, country, year, mapped_population)
+
+    # reduce size of data for debugging.
+    # Number of days must be enough for number of days of reference temperature!
+
+    if args.debug:
+    #   temperature = temperature['2018-01-01 00:00:00' : '2018-01-05 23:00:00']
+        print(temperature)
+
+    # Account for climate change
+    if args.climate:
+        print('Accounting for Climate Change')
+        temperature = preprocess.climate(temperature, year)
+
+    # Reference temperature
+
+    num_previous = args.temp_days
+    print('Reference temp for ' + str(num_previous) + ' days ... ')
+
+    if stream is None:
+        reference_temperature = demand.reference_temperature(temperature['air'],num_previous)
+    else:
+        reference_temperature = demand.reference_temperature(temperature['air'],num_previous, stream['previous'])
+        stream['previous'] = demand.reference_state(temperature['air'], num_previous, stream['previous'])
+
+    print('Daily parms ... ')
+    daily_parameters = context.read('daily_parameters')
+
+    if args.debug:
+        print('Windy locations')
+        windy_locations = {
+            'normal': wind[wind <= 4.4].index,
+            'windy': wind[wind > 4.4].index
+        }
+        for windiness, locations in windy_locations.items():
+            print(windiness)
+            print(len(locations))
+            print(locations)
+
+    profile_parameters = {}
+    for profile in profile_list:
+        profile_parameters[profile] = context.hourly_parameters(profile)
+
+        # plot hourly profiles to check
+        if args.plot:
+            plots.hourly_profile(profile_parameters[profile])
+
+    # The temperature classes of the hourly profiles are the same for all
+    # methods and profiles
+    if not args.chunked:
+        temperature_classes = demand.temperature_classes_hourly(reference_temperature)
+
+    annual_demands = context.read('annual_demand', country)
+    annual_demand_ref = annual_demands.loc[ref]
+    annual_space = { 'residential' : annual_demand_ref['domestic_space'], 'commercial' : annual_demand_ref['services_space'] }
+    annual_water = { 'residential' : annual_demand_ref['domestic_water'], 'commercial' : annual_demand_ref['services_water'] }
+    if year != ref:
+        # hdd for reference year.
+        hdd_ref = annual_demand_ref['hdd']
+        if hdd_ref == 0.0:
+            raise ValueError('Reference year not equal to weather year, but hdd in {}.csv is 0.0'.format(country) )
+    #   get hdd for weather year
+        hdd = demand.hdd(reference_temperature, mapped_population, base_temp=15.5)
+        # Adverse weather scenarios are 2 years therefore divide by 2
+        if args.adverse:
+            hdd = hdd / 2.0
+        print ('Reference year not equal to weather year, scale by hdd {} hdd_ref {} '.format(hdd,hdd_ref))
+        annual_space['residential'] = annual_space['residential'] * hdd / hdd_ref
+        annual_space['commercial'] = annual_space['commercial'] * hdd / hdd_ref
+
+    # Air, ground, water temp for each grid point
+    source_temperature = cop.source_temperature(temperature)
+    sink_temperature = cop.sink_temperature(temperature)
+
+    # coefficient of performance
+
+    # Only the national COP is written, so the COP of each grid point is
+    # worked out for one sink and source at a time when it is needed
+    cop_parameters = context.read('cop_parameters')
+    spatial_cop = cop.spatial_cop(source_temperature, sink_temperature, cop_parameters, lazy=True)
+
+    if args.electric:
+        # Read in combination of ASHP GSHP etc.
+        parm_heat, parm_water = context.read('electric_parameters', country)
+        electric_parameters = { 'heating_types': parm_heat, 'hot_water_types':parm_water}
+
+    # hourly air temperature
+    t = temperature['air'].mean_cells() - 273.15
+    t.rename('temperature', inplace=True)
+    t = localize(t, country).tz_convert('utc')
+    # hourly soil temperature
+    g = temperature['soil'].mean_cells() - 273.15
+    g.rename('soiltemp', inplace=True)
+    g = localize(g, country).tz_convert('utc')
+
+    # The water heating of the two HDD methods is the same, so it is only
+    # worked out once
+    water_methods = { "B" : "BDEW", "W" : "Watson", "S" : "HDD", "H" : "HDD" }
+    daily_waters = {}
+    spatial_waters = {}
+    output_files = {}
+
+    for method in method_list:
+
+        print('Daily heat and water for {} ... '.format(methods[method]))
+        if method == 'B':
+            daily_heat = demand.daily_heat(reference_temperature, wind, daily_parameters)
+            daily_water = demand.daily_water
+
+        if method == 'W':
+            daily_heat = demand.watson_daily_heat(reference_temperature, wind, daily_parameters)
+            daily_water = demand.watson_daily_water
+
+        if method == 'H':
+            daily_heat = demand.hdd_daily_heat(reference_temperature, wind, daily_parameters, 12.8)
+            daily_water = demand.hdd_daily_water
+
+        if method == 'S':
+            daily_heat = demand.hdd_daily_heat(reference_temperature, wind, daily_parameters, 15.5)
+            daily_water = demand.hdd_daily_water
+
+        water_method = water_methods[method]
+        if water_method not in daily_waters:
+            daily_waters[water_method] = daily_water(reference_temperature, wind, daily_parameters)
+        daily_water = daily_waters[water_method]
+
+        if args.debug:
+            print('daily_heat')
+            print(daily_heat)
+
+        # The daily demand is the same for every profile, only the hourly
+        # factors differ
+        for profile in profile_list:
+
+            hourly_parameters = profile_parameters[profile]
+
+            if args.chunked:
+                # The hourly stages a month at a time
+                final_heat, heat_pump_heat, heat_pump_power = chunked.heat_pump_series(
+                    daily_heat, daily_water, reference_temperature, hourly_parameters, method,
+                    mapped_population, annual_space, annual_water, args.efficiency, spatial_cop, country)
+            else:
+                print('Hourly heat for {} profile ... '.format(profile))
+                hourly_heat = demand.hourly_heat(daily_heat,
+                                                 reference_temperature,
+                                                 hourly_parameters,
+                                                 temperature_classes)
+                if args.debug:
+                    print('hourly_heat')
+                    print(hourly_heat)
+
+                if (water_method, profile) in spatial_waters:
+                    hourly_water, spatial_water = spatial_waters[(water_method, profile)]
+                else:
+                    print('Hourly water ... ')
+                    hourly_water = demand.hourly_water(daily_water,
+                                                       reference_temperature,
+                                                       hourly_parameters)
+
+                    print ('spatial_water')
+                    spatial_water = demand.finishing(hourly_water, mapped_population, annual_water, args.efficiency)
+                    spatial_waters[(water_method, profile)] = hourly_water, spatial_water
+
+                # For the other methods, we are calculating the hourly space heating.
+                if method == 'B':
+                    hourly_space = (hourly_heat - hourly_water).clip(lower=0)
+                else:
+                    hourly_space = hourly_heat.clip(lower=0)
+
+                print ('spatial_space')
+                spatial_space = demand.finishing(hourly_space, mapped_population, annual_space, args.efficiency)
+
+                final_heat = demand.combine(spatial_space, spatial_water)
+
+                # National heat and heat pump power, shared by the COP and electricity
+                heat_pump_heat, heat_pump_power = cop.aggregate(spatial_cop, spatial_space, spatial_water, country)
+
+            final_cop = cop.finishing(heat_pump_heat, heat_pump_power, args.ceta)
+
+            # Calculate an electricity demand
+            if args.electric:
+                electric_series = electric.finishing(heat_pump_heat, heat_pump_power, electric_parameters)
+                electric_sum = electric_series.sum() / 1000000.0
+                print('Total Electric = {:.2f} TWh'.format(electric_sum))
+            else:
+                electric_series = pd.Series()
+
+            # output the csv file
+            output_file = output_file_name(method, profile)
+            append = stream is not None and stream['append']
+            write.combined_csv( output_file, final_heat, final_cop, t, g, electric_series, args.adverse, append)
+            print('Output written to {}'.format(output_file))
+            output_files[(method, profile)] = output_file
+
+    if stream is not None:
+        stream['append'] = True
+
+    return output_files
@@ -1,80 +1,193 @@
 
 import os
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+from pyproj import Transformer
 from shapely.geometry import Point
+from matplotlib.path import Path
 
 from . import read
+from . import cache
 from .misc import upsample_df
+from .grid import GridSeries
+
+# Built in regions as boxes [north, west, south, east] in degrees, as for
+# the area of the weather download. Cells strictly inside the box are in.
+regions = {
+    'NI': [55.2, -np.inf, 52.5, -5.18],
+}
+
+def region(spec):
+
+    # A region is a built in name, a csv file of longitude, latitude polygon
+    # vertices or a box north,west,south,east
+    if spec in regions:
+        return regions[spec]
+    if os.path.isfile(spec):
+        return pd.read_csv(spec, usecols=['longitude', 'latitude'])[['longitude', 'latitude']].values
+    return [float(x) for x in spec.split(',')]
+
+def region_mask(cells, area):
+
+    # Boolean array of which (latitude, longitude) cells are in the area,
+    # a region name, a box [north, west, south, east] or a polygon given as
+    # an array of (longitude, latitude) vertices
+    if not isinstance(cells, pd.MultiIndex):
+        cells = pd.MultiIndex.from_tuples(list(cells), names=('latitude', 'longitude'))
+    latitude = cells.get_level_values(0).values
+    longitude = cells.get_level_values(1).values
+
+    if isinstance(area, str):
+        area = regions[area]
+    if np.ndim(area) == 2:
+        polygon = Path(np.asarray(area, dtype=float))
+        return polygon.contains_points(np.column_stack([longitude, latitude]))
+
+    north, west, south, east = area
+    return (latitude < north) & (latitude > south) & (longitude > west) & (longitude < east)
+
+def select_region(s, area):
+
+    return s[region_mask(s.index, area)]
 
 def split_northern_ireland(s,keep=False):
-    mainland=[]
-    ni=[]
-    for items in s.iteritems():
-        latitude=items[0][0]
-        longitude=items[0][1]
-        if longitude < -5.18 and latitude < 55.2 and latitude > 52.5:
-            ni.append(items[0])
-        else:
-            mainland.append(items[0])
+    ni = region_mask(s.index, 'NI')
     if keep:
-        new_s = s.loc[ni]
+        new_s = s[ni]
     else:
-        new_s = s.loc[mainland]
+        new_s = s[~ni]
     return new_s
 
-def map_population(input_path, interim_path, country, adverse,  interim=True, year=None, grid='I', plot=True):
+def grid_positions(values, coordinates):
+
+    # Position of each value in a regular grid of coordinates, the cell being
+    # the square of side the grid spacing centred on the coordinate.
+    # Values outside the grid get -1.
+    step = coordinates[1] - coordinates[0]
+    i = np.floor((values - coordinates[0]) / step + 0.5).astype(int)
+    i[(i < 0) | (i >= len(coordinates))] = -1
+    return i
+
+def grid_cells(population, latitude, longitude):
+
+    # Transform the cell centres from EPSG:3035 to latitude/longitude
+    transformer = Transformer.from_crs('epsg:3035', 'epsg:4326', always_xy=True)
+    lon, lat = transformer.transform(population['x'].values, population['y'].values)
+
+    # The weather grid is regular so the weather cell of each population
+    # cell comes from dividing by the grid spacing.
+    # Cells are numbered latitude * len(longitude) + longitude, -1 if outside
+    ilat = grid_positions(lat, np.asarray(latitude))
+    ilon = grid_positions(lon, np.asarray(longitude))
+    cell = ilat * len(longitude) + ilon
+    cell[(ilat < 0) | (ilon < 0)] = -1
+    return cell
+
+def cell_index(cells, latitude, longitude):
+
+    # (latitude, longitude) MultiIndex from grid cell numbers
+    return pd.MultiIndex.from_arrays(
+        [np.asarray(latitude)[cells // len(longitude)], np.asarray(longitude)[cells % len(longitude)]],
+        names=('latitude', 'longitude'))
+
+def bin_population(population, latitude, longitude):
+
+    cell = grid_cells(population, latitude, longitude)
+    inside = cell >= 0
+
+    # Sum up population, keeping the weather cells with population cells in
+    totals = np.bincount(cell[inside], weights=population['TOT_P'].values[inside],
+                         minlength=len(latitude) * len(longitude))
+    cells = np.flatnonzero(np.bincount(cell[inside], minlength=len(totals)))
+
+    index = cell_index(cells, latitude, longitude)
+    s = pd.Series(totals[cells].round().astype('int64'), index=index, name='TOT_P')
+
+    return s.sort_index()
+
+def map_population_europe(input_path, interim_path, interim=True, year=None, grid='I'):
+
+    # Map the whole GEOSTAT grid onto the weather grid once, giving a table
+    # of country, latitude, longitude, TOT_P from which any country is
+    # sliced. GB and NI are split out of UK.
+
+    # Keyed by the grid coordinates, so the mapping is shared by the
+    # weather years
+    filename = read.wind_filename(None, interim, year, grid)
+    latitude, longitude = read.coordinates(input_path, filename)
+    key = cache.key('population{}_europe'.format(grid), [read.population_file(input_path)],
+                    grid=cache.grid_hash(latitude, longitude))
+    df = cache.load(interim_path, key)
+
+    if df is None:
+
+        population = read.population(input_path)
+
+        print(' binning population for all countries .....')
+        cell = grid_cells(population, latitude, longitude)
+        inside = cell >= 0
+        df = pd.DataFrame({'country': population['CNTR_CODE'].values[inside],
+                           'cell': cell[inside],
+                           'TOT_P': population['TOT_P'].values[inside]})
+        df = df.groupby(['country', 'cell'], observed=True)['TOT_P'].sum().reset_index()
+        index = cell_index(df['cell'].values, latitude, longitude)
+        df = pd.DataFrame({'country': df['country'].values,
+                           'latitude': index.get_level_values('latitude'),
+                           'longitude': index.get_level_values('longitude'),
+                           'TOT_P': df['TOT_P'].values.astype('int64')})
+
+        # Great Britain and Northern Ireland from the UK
+        uk = df[df['country'] == 'UK'].set_index(['latitude', 'longitude'])['TOT_P']
+        regions = [df]
+        for country, keep in [('GB', False), ('NI', True)]:
+            s = split_northern_ireland(uk, keep).reset_index()
+            s.insert(0, 'country', country)
+            regions.append(s)
+        df = pd.concat(regions, ignore_index=True)
+        df['country'] = df['country'].astype('category')
+
+        cache.save(interim_path, key, df)
+
+    return df
+
+def map_population(input_path, interim_path, country, adverse,  interim=True, year=None, grid='I', plot=True, europe=False):
 
-    weather_grid = None
     mapped_population = {}
 
+    # The weather grid comes from the coordinates of the wind file and keys
+    # the mapping, so it is shared by the weather years
+    filename = read.wind_filename(adverse, interim, year, grid)
+    latitude, longitude = read.coordinates(input_path, filename)
+    files = [read.population_file(input_path)]
     if adverse:
-        file = os.path.join(interim_path, 'population_adverse')
+        key = cache.key('population_adverse', files, grid=cache.grid_hash(latitude, longitude))
     else:
-        file = os.path.join(interim_path, 'population{}_{}'.format(grid,country))
+        key = cache.key('population{}_{}'.format(grid,country), files, grid=cache.grid_hash(latitude, longitude))
 
-    if not os.path.isfile(file):
+    if europe and not adverse:
 
-        population = read.population(input_path)
-        if adverse:
-            weather_data = read.wind_adverse(input_path, adverse)
-        else:
-            if interim:
-                weather_data = read.wind(input_path)  # For the weather grid
-            else:
-                weather_data = read.wind_era5(input_path, year, grid)
+        # Slice the country from the mapping of all countries
+        df = map_population_europe(input_path, interim_path, interim, year, grid)
+        df = df[df['country'] == country]
+        s = df.set_index(['latitude', 'longitude'])['TOT_P'].sort_index()
 
-        # Make GeoDataFrame from the weather data coordinates
-        weather_grid = gpd.GeoDataFrame(index=weather_data.columns)
-        weather_grid['geometry'] = weather_grid.index.map(lambda i: Point(reversed(i)))
-
-        # Set coordinate reference system to 'latitude/longitude'
-        weather_grid.crs = {'init': 'epsg:4326'}
+    else:
+        s = cache.load(interim_path, key)
 
-        # Make polygons around the weather points
-        weather_grid['geometry'] = weather_grid.geometry.apply(lambda point: point.buffer(.75 / 2, cap_style=3))
+    if s is None:
 
-        # Make list from MultiIndex (this is necessary for the spatial join)
-        weather_grid.index = weather_grid.index.tolist()
+        population = read.population(input_path)
 
         # Filter population data by country to cut processing time
         if country == 'GB' or country == 'NI':
-            gdf = population[population['CNTR_CODE'] == 'UK'].copy()
+            df = population[population['CNTR_CODE'] == 'UK']
         else:
-            gdf = population[population['CNTR_CODE'] == country].copy()
-
-        # Align coordinate reference systems
-        print(' aligning coords .....')
-        gdf = gdf.to_crs({'init': 'epsg:4326'})
-
-        # Spatial join
-        # This must map the population onto the weather grid since
-        # the UK weather grid contains 128022 points!
-        print(' spatial join .....')
-        gdf = gpd.sjoin(gdf, weather_grid, how="left", op='within')
+            df = population[population['CNTR_CODE'] == country]
 
-        # Sum up population
-        s = gdf.groupby('index_right')['TOT_P'].sum()
+        # Map the population onto the weather grid
+        print(' binning population .....')
+        s = bin_population(df, latitude, longitude)
 
         # Remove NI if GB
         if country == 'GB':
@@ -82,12 +195,7 @@ def map_population(input_path, interim_path, country, adverse,  interim=True, ye
         if country == 'NI':
             s = split_northern_ireland(s,True)
         # Write results to interim path
-        s.to_pickle(file)
-
-    else:
-
-        s = pd.read_pickle(file)
-        print('{} already exists and is read from disk.'.format(file))
+        cache.save(interim_path, key, s)
 
     mapped_population = s
 
@@ -104,24 +212,24 @@ def map_population(input_path, interim_path, country, adverse,  interim=True, ye
 def wind(input_path, mapped_population, interim, year, grid='I', plot=True, adverse=None):
 
     if adverse:
-        df = read.wind_adverse(input_path, adverse)
+        variables = ['wind_speed']
     else:
         if interim:
-            df = read.wind(input_path)
+            variables = ['si10']
         else:
-            df = read.wind_era5(input_path, year, grid)
+            variables = ['u10', 'v10']
+    filename = read.wind_filename(adverse, interim, year, grid)
 
     # Temporal average
-    s = df.mean(0)
+    # Only the population grid points are read, a slab of time at a time
+    pd_wind = read.wind_mean(input_path, filename, variables, mapped_population.index)
 
     if plot:
         print('Plot of the wind averages for visual inspection:')
-        gdf = gpd.GeoDataFrame(s, columns=['wind'])
+        gdf = gpd.GeoDataFrame(pd_wind, columns=['wind'])
         gdf['geometry'] = gdf.index.map(lambda i: Point(reversed(i)))
         gdf.plot(column='wind', legend=True)
 
-    # Wind data is filtered by population grid points for GB
-    pd_wind = s.loc[mapped_population.index.tolist()]
     return pd_wind
 
 def temperature_daily2hourly(input_path, t):
@@ -148,41 +256,58 @@ def temperature(input_path, year, mapped_population, interim_path, adverse, coun
             'air': 't2m',
             'soil': 'stl4'
         }
+        # Only the population grid points are read from the file
         t = pd.concat(
-                [read.temp_adverse(input_path, adverse, parameter) for parameter in parameters.values()],
+                [read.temp_adverse(input_path, adverse, parameter, mapped_population.index) for parameter in parameters.values()],
             keys=parameters.keys(), names=['parameter', 'latitude', 'longitude'], axis=1
         )
 
-        t = temperature_daily2hourly(input_path, t)
+        temp_data = GridSeries.from_frame(temperature_daily2hourly(input_path, t))
 #       t.to_pickle("/home/malcolm/uclan/tools/python/scripts/heat/output/adv/pickle")
 
-        temp_data = pd.concat(
-            [t[parameter][mapped_population.index.tolist()] for parameter in parameters.keys()], keys=parameters.keys(), names=['parameter', 'latitude', 'longitude'], axis=1)
-
     else:
-        file = os.path.join(interim_path, 'temperature_' + grid + country + str(year))
+        # Keyed by the grid points so that regions and countries differ
+        filename = read.era5_filename(year, hour, grid, 'temperature')
+        key = cache.key('temperature_' + grid + country + str(year),
+                        [read.weather_file(input_path, filename)],
+                        cells=list(mapped_population.index))
+        arrays = cache.load_arrays(interim_path, key)
 
-        if os.path.isfile(file):
-            temp_data = pd.read_pickle(file)
-            print('temperature preprocessed {} already exists and is read from disk.'.format(file))
-        else:
+        if arrays is None:
 
             parameters = {
                 'air': 't2m',
                 'soil': 'stl4'
             }
+            # Only the population grid points are read from the file
             t = pd.concat(
-                [read.weather_era5(input_path, year, hour, grid, 'temperature', parameter) for parameter in parameters.values()],
+                [read.weather_era5(input_path, year, hour, grid, 'temperature', parameter, mapped_population.index) for parameter in parameters.values()],
             keys=parameters.keys(), names=['parameter', 'latitude', 'longitude'], axis=1
             )
 
             t = upsample_df(t, '60min')
 
-            temp_data = pd.concat(
-            [t[parameter][mapped_population.index.tolist()] for parameter in parameters.keys()], keys=parameters.keys(), names=['parameter', 'latitude', 'longitude'], axis=1)
-
-            # Write results to interim path
-            temp_data.to_pickle(file)
+            # Write results to interim path as a float32 time x grid point
+            # array with the time and column coordinates alongside
+            arrays = {
+                'values': t.values.astype('float32'),
+                'time': t.index.values.astype('datetime64[ns]'),
+                'parameter': t.columns.get_level_values('parameter').values.astype('U'),
+                'latitude': t.columns.get_level_values('latitude').values,
+                'longitude': t.columns.get_level_values('longitude').values,
+            }
+            arrays = cache.save_arrays(interim_path, key, arrays)
+
+        # The values stay memory mapped so only the pages used are read.
+        # The columns are all the cells for air then for soil.
+        parameters = list(pd.unique(arrays['parameter']))
+        ncells = len(arrays['parameter']) // len(parameters)
+        cells = pd.MultiIndex.from_arrays(
+            [arrays['latitude'][:ncells], arrays['longitude'][:ncells]],
+            names=['latitude', 'longitude'])
+        temp_data = GridSeries(arrays['values'].reshape(len(arrays['time']), len(parameters), ncells),
+                               pd.DatetimeIndex(arrays['time'], name='time'),
+                               cells, [('parameter', parameters)])
 
 #   print(temp_data.index)
 #   quit()
@@ -190,6 +315,6 @@ def temperature(input_path, year, mapped_population, interim_path, adverse, coun
 
 def climate(temperature, year):
     temperature_change = (2020 - year) / 40.0
-    temperature['air'] = temperature['air'] + temperature_change
-    temperature['soil'] = temperature['soil'] + temperature_change
+    # Both the air and soil temperature change
+    temperature = temperature + temperature_change
     return temperature
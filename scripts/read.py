@@ -1,67 +1,110 @@
 
 import os
 import pandas as pd
-import geopandas as gpd
 import numpy as np
 from netCDF4 import Dataset, num2date
-from shapely.geometry import Point
 
 
-def temperature(input_path, year_start, year_end, param):
+def temperature(input_path, year_start, year_end, param, cells=None):
 
     return pd.concat(
-        [weather(input_path, 'ERA_temperature_{}.nc'.format(year), param) for year in range(year_start, year_end+1)],
+        [weather(input_path, 'ERA_temperature_{}.nc'.format(year), param, cells) for year in range(year_start, year_end+1)],
         axis=0
     )
 
-def weather_era5(input_path, year, hour, grid, name, param):
-    filename = 'ERA{}{}_{}_{}.nc'.format(hour,grid,name,year)
-    return pd.concat( [weather(input_path, filename, param) ], axis=0)
+def era5_filename(year, hour, grid, name):
+    return 'ERA{}{}_{}_{}.nc'.format(hour,grid,name,year)
 
-def wind_adverse(input_path, adverse):
-    filename = 'adverse/{}_{}.nc'.format(adverse,'windspeed')
-    print('Reading adverse wind')
-    daily = weather(input_path, filename, 'wind_speed')
-    print(daily)
-    return daily
+def weather_era5(input_path, year, hour, grid, name, param, cells=None):
+    filename = era5_filename(year, hour, grid, name)
+    return pd.concat( [weather(input_path, filename, param, cells) ], axis=0)
 
-def temp_adverse(input_path, adverse, parameter):
+def temp_adverse(input_path, adverse, parameter, cells=None):
     filename = 'adverse/{}_{}.nc'.format(adverse,'tas')
     print('Reading adverse temperature')
-    daily = weather(input_path, filename, 't2m')
+    daily = weather(input_path, filename, 't2m', cells)
     # assume soil temperature is 1 degree higher
     if parameter == 'stl4':
         daily = daily + 1.0
     print(daily)
     return daily
 
-def wind(input_path):
+def wind_filename(adverse=None, interim=False, year=None, grid='I'):
+
+    if adverse:
+        return 'adverse/{}_{}.nc'.format(adverse,'windspeed')
+    if interim:
+        return 'ERA_wind.nc'
+    return 'ERA{}{}_wind.nc'.format(grid,year)
+
+def weather_file(input_path, filename):
+    return os.path.join(input_path, 'weather', filename)
+
+def coordinates(input_path, filename):
+
+    file = weather_file(input_path, filename)
+
+    # Only the coordinate variables are read, the weather data is left on disk
+    with Dataset(file) as nc:
+        latitude = nc.variables['latitude'][:]
+        longitude = nc.variables['longitude'][:]
+
+    return latitude, longitude
+
+def cell_positions(latitude, longitude, cells):
 
-    return weather(input_path, 'ERA_wind.nc', 'si10')
+    # Positions of the (latitude, longitude) cells in the coordinate arrays
+    cells = pd.MultiIndex.from_tuples(list(cells), names=('latitude', 'longitude'))
+    ilat = pd.Index(np.asarray(latitude)).get_indexer(cells.get_level_values('latitude'))
+    ilon = pd.Index(np.asarray(longitude)).get_indexer(cells.get_level_values('longitude'))
+    if (ilat < 0).any() or (ilon < 0).any():
+        raise KeyError('Grid cells not found in the weather file')
+
+    return cells, ilat, ilon
+
+def cell_slices(latitude, longitude, cells):
+
+    # Bounding box of the cells as slices of the netCDF latitude/longitude
+    # dimensions, and the positions of the cells within that box
+    cells, ilat, ilon = cell_positions(latitude, longitude, cells)
+    lat_slice = slice(ilat.min(), ilat.max() + 1)
+    lon_slice = slice(ilon.min(), ilon.max() + 1)
+
+    return cells, lat_slice, lon_slice, ilat - lat_slice.start, ilon - lon_slice.start
+
+def wind_mean(input_path, filename, variables, cells, slab=744):
+
+    # Temporal mean of the wind speed at the given cells. The file is read
+    # slab time steps at a time and only over the bounding box of the cells,
+    # so memory is bounded by one slab whatever the grid or the length of
+    # the year. With two variables (u10, v10) the speed is sqrt(u^2 + v^2).
 
-def wind_era5(input_path, year, grid):
-    filename = 'ERA{}{}_wind.nc'.format(grid,year)
     file = os.path.join(input_path, 'weather', filename)
 
-    # Read the netCDF file
-    nc = Dataset(file)
-    time = nc.variables['time'][:]
-    time_units = nc.variables['time'].units
-    latitude = nc.variables['latitude'][:]
-    longitude = nc.variables['longitude'][:]
-    u10 = nc.variables['u10'][:]
-    v10 = nc.variables['v10'][:]
-    variable = np.sqrt(np.square(u10) + np.square(v10))
-    times=num2date(time, time_units,only_use_cftime_datetimes=False,only_use_python_datetimes=True)
-    # Transform to pd.DataFrame
-    df = pd.DataFrame(data=variable.reshape(len(time), len(latitude) * len(longitude)),
-                      index=pd.DatetimeIndex(times, name='time'),
-                      columns=pd.MultiIndex.from_product([latitude, longitude],
-                                                         names=('latitude', 'longitude')))
+    with Dataset(file) as nc:
+        latitude = nc.variables['latitude'][:]
+        longitude = nc.variables['longitude'][:]
+        cells, lat_slice, lon_slice, ilat, ilon = cell_slices(latitude, longitude, cells)
 
-    return df
+        total = np.zeros(len(cells))
+        count = np.zeros(len(cells))
+        ntime = len(nc.dimensions['time'])
+        for start in range(0, ntime, slab):
+            time_slice = slice(start, min(start + slab, ntime))
+            components = []
+            for name in variables:
+                data = nc.variables[name][time_slice, lat_slice, lon_slice]
+                components.append(np.ma.filled(data.astype('float64'), np.nan)[:, ilat, ilon])
+            speed = np.sqrt(sum(np.square(c) for c in components)) if len(components) > 1 else components[0]
+            total += np.nansum(speed, axis=0)
+            count += np.sum(~np.isnan(speed), axis=0)
+
+    return pd.Series(total / count, index=cells)
+
+def weather(input_path, filename, variable_name, cells=None):
 
-def weather(input_path, filename, variable_name):
+    # If cells (latitude, longitude) are given only their bounding box is
+    # read from the file and the columns are the cells in the order given.
 
     file = os.path.join(input_path, 'weather', filename)
 
@@ -72,41 +115,74 @@ def weather(input_path, filename, variable_name):
     time_units = nc.variables['time'].units
     latitude = nc.variables['latitude'][:]
     longitude = nc.variables['longitude'][:]
-    variable = nc.variables[variable_name][:]
+    if cells is not None:
+        columns, lat_slice, lon_slice, ilat, ilon = cell_slices(latitude, longitude, cells)
+        variable = nc.variables[variable_name][:, lat_slice, lon_slice][:, ilat, ilon]
+    else:
+        variable = nc.variables[variable_name][:]
+        columns = pd.MultiIndex.from_product([latitude, longitude],
+                                             names=('latitude', 'longitude'))
     times=num2date(time, time_units,only_use_cftime_datetimes=False,only_use_python_datetimes=True)
+    nc.close()
     # Transform to pd.DataFrame
-    df = pd.DataFrame(data=variable.reshape(len(time), len(latitude) * len(longitude)),
+    df = pd.DataFrame(data=variable.reshape(len(time), len(columns)),
 #                     index=pd.Index(num2date(time, time_units), name='time'),
                       index=pd.DatetimeIndex(times, name='time'),
 #                     index=pd.DatetimeIndex(pd.Series(num2date(time, time_units)), name='time'),
 #                     index=pd.TimedeltaIndex(num2date(time, time_units), name='time'),
 #                     index=pd.PeriodIndex(num2date(time, time_units), name='time'),
-                      columns=pd.MultiIndex.from_product([latitude, longitude],
-                                                         names=('latitude', 'longitude')))
+                      columns=columns)
 
     return df
 
 
-def population(input_path):
+def population_columns(csv_file, columns_path):
 
-    directory = 'population/Version 2_0_1/'
-    filename = 'GEOSTAT_grid_POP_1K_2011_V2_0_1.csv'
+    # One-time conversion of the GEOSTAT csv into a binary column per file
+    # with the GRD_ID eg 1kmN2689E4337 split into northing and easting in km
+    df = pd.read_csv(csv_file, usecols=['GRD_ID', 'TOT_P', 'CNTR_CODE'])
+    km = df['GRD_ID'].str.extract(r'N(\d+)E(\d+)')
+    country = df['CNTR_CODE'].astype('category')
+
+    os.makedirs(columns_path, exist_ok=True)
+    columns = {
+        'northing': km[0].values.astype('int32'),
+        'easting': km[1].values.astype('int32'),
+        'population': df['TOT_P'].values.astype('int32'),
+        'country': country.cat.codes.values.astype('int8'),
+        'countries': country.cat.categories.values.astype('U'),
+    }
+    for name, values in columns.items():
+        np.save(os.path.join(columns_path, name + '.npy'), values)
 
-    # Read population data
-    df = pd.read_csv(os.path.join(input_path, directory, filename),
-                     usecols=['GRD_ID', 'TOT_P', 'CNTR_CODE'],
-                     index_col='GRD_ID')
+def population_file(input_path):
 
-    # Make GeoDataFrame from the the coordinates in the index
-    gdf = gpd.GeoDataFrame(df)
-    gdf['geometry'] = df.index.map(lambda i: Point(
-        [1000 * float(x) + 500 for x in reversed(i.split('N')[1].split('E'))]
-    ))
+    directory = 'population/Version 2_0_1/'
+    filename = 'GEOSTAT_grid_POP_1K_2011_V2_0_1.csv'
+    return os.path.join(input_path, directory, filename)
 
-    # Transform coordinate reference system to 'latitude/longitude'
-    gdf.crs = {'init': 'epsg:3035'}
+def population(input_path):
 
-    return gdf
+    csv_file = population_file(input_path)
+    columns_path = os.path.join(input_path, 'population', 'GEOSTAT_grid_POP_1K_2011_V2_0_1')
+
+    # Convert the csv the first time (or if it has changed)
+    stamp = os.path.join(columns_path, 'countries.npy')
+    if not os.path.isfile(stamp) or os.path.getmtime(stamp) < os.path.getmtime(csv_file):
+        print('Converting {} to binary columns in {}'.format(csv_file, columns_path))
+        population_columns(csv_file, columns_path)
+
+    # Memory map the columns
+    def column(name):
+        return np.load(os.path.join(columns_path, name + '.npy'), mmap_mode='r')
+
+    # The centre of the cell in EPSG:3035 metres is 1000 * km + 500
+    return pd.DataFrame({
+        'x': 1000 * column('easting').astype('int64') + 500,
+        'y': 1000 * column('northing').astype('int64') + 500,
+        'TOT_P': column('population'),
+        'CNTR_CODE': pd.Categorical.from_codes(column('country'), column('countries')),
+    })
 
 
 def daily_parameters(input_path):
@@ -70,7 +70,7 @@ def to_csv(shaped_dfs, output_path):
             file = os.path.join(output_path, 'when2heat_{}.csv'.format(shape))
             df.to_csv(file, float_format='%g')
 
-def combined_csv(output_file, demand, cop, temp, gtemp, electric, adverse):
+def combined_csv(output_file, demand, cop, temp, gtemp, electric, adverse, append=False):
 
     # Merge everything
     if len(electric)==0:
@@ -88,7 +88,11 @@ def combined_csv(output_file, demand, cop, temp, gtemp, electric, adverse):
         str_year = df.index[0][0:4]
         if str_year == '1969' or  str_year == '1968':
             df = df.iloc[1: , :]
-    df.to_csv(output_file, sep=',', decimal='.', float_format='%g')
+    # Appending continues a series of several years
+    if append:
+        df.to_csv(output_file, sep=',', decimal='.', float_format='%g', mode='a', header=False)
+    else:
+        df.to_csv(output_file, sep=',', decimal='.', float_format='%g')
 
 def demand_csv(demand, output_file):
 